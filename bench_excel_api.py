@@ -0,0 +1,639 @@
+# bench_excel_api.py
+"""
+excel_api のベンチマーク。
+
+乱数種から決まる合成コーパス（xlsx / xls / eml / msg）を作り、
+_excel_sparse_from_bytes / _handle_eml_bytes / _handle_msg_bytes と Flask エンドポイント
+（テストクライアント経由）を計測する。スループット・レイテンシのパーセンタイル・ピークRSSを出し、
+JSON のベースラインに保存して次回と比較できる。
+
+  python bench_excel_api.py                          # 全ケースを計測して表示
+  python bench_excel_api.py -k xlsx_dense            # ケース名の部分一致で絞り込み
+  python bench_excel_api.py --save bench.json        # 結果をベースラインとして保存
+  python bench_excel_api.py --compare bench.json     # ベースラインと比較（劣化があれば終了コード 1）
+  python bench_excel_api.py --write-corpus corpus/   # 生成したコーパスを書き出すだけ
+  python bench_excel_api.py --imports                # 起動時間：import のコストを解析ライブラリ別に計測
+
+各ケースは別プロセスで実行し、そのプロセスのピークRSSを測る（--no-isolate で同一プロセス）。
+抽出結果キャッシュは無効、解析プロセスプールは既定で使わない（--pool-workers で指定）。
+.xls の生成には xlwt が必要（無ければ .xls のケースは飛ばす）。
+"""
+import os, sys, json, random, time, argparse, subprocess, tempfile, platform, resource, struct, statistics, zipfile
+from datetime import date, datetime, timedelta
+from io import BytesIO
+from typing import Dict, List
+
+from openpyxl import Workbook
+from openpyxl.xml.constants import ARC_CORE
+from openpyxl.xml.functions import tostring
+
+try:
+    import xlwt  # .xls 生成用（任意）
+except ImportError:
+    xlwt = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_XLSX = "スキルシート【YK】36歳女性_小田急小田原線_新百合ヶ丘駅.xlsx"
+
+DEFAULT_THRESHOLD = 0.20       # p50 がこの割合以上遅くなったら劣化とみなす
+DEFAULT_RSS_THRESHOLD = 0.25   # 計測中に増えた RSS がこの割合以上増えたら劣化
+RSS_NOISE_KB = 4096            # RSS の増分がこれ未満の差は無視する
+
+# ========= 合成コーパス =========
+
+_KANA = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン"
+_WORDS = [
+    "要件定義", "基本設計", "詳細設計", "製造", "単体テスト", "結合テスト", "総合テスト", "保守", "運用",
+    "官公庁向け", "金融機関向け", "製造業向け", "流通業向け", "システム刷新", "ワークフロー", "業務システム",
+    "エラーログ解析", "リグレッションテスト", "障害対応", "設計書修正", "コーディング", "レビュー",
+    "Java", "JUnit", "Oracle", "PostgreSQL", "Spring Boot", "Python", "AWS", "Docker", "GitLab", "Eclipse",
+]
+_STATIONS = ["小田急小田原線", "京王線", "東急田園都市線", "JR中央線", "JR山手線", "東京メトロ丸ノ内線"]
+_PHASES = ["要件定義", "基本設計", "詳細設計", "製造", "単体", "結合", "総合", "保守"]
+
+def _phrase(rng: random.Random, n_words: int) -> str:
+    return "、".join(rng.choice(_WORDS) for _ in range(n_words))
+
+def _skill_sheet_cells(rng: random.Random, n_projects: int) -> List[tuple]:
+    # 同梱のスキルシートと同じ配置（見出し B 列、値 G 列、右側の見出し Z 列・値 AE 列、業務経歴の表）
+    cells = [(2, 2, "スキルシート")]
+    initials = rng.choice(_KANA) + rng.choice(_KANA)
+    cells += [(5, 2, "技術者名"), (5, 7, initials), (5, 26, "性別"), (5, 31, rng.choice(["男性", "女性"])),
+              (6, 2, "年齢"), (6, 7, f"{rng.randint(22, 60)}歳"), (6, 26, "最寄駅"),
+              (6, 31, f"{rng.choice(_STATIONS)}　{rng.choice(_KANA)}{rng.choice(_KANA)}駅"),
+              (7, 2, "資格"), (7, 7, " ".join(rng.choice(_WORDS) + "試験" for _ in range(4))),
+              (7, 26, "学歴"), (7, 31, f"{rng.choice(_KANA)}{rng.choice(_KANA)}大学　卒業"),
+              (9, 2, "得意分野"), (9, 7, _phrase(rng, 3)),
+              (10, 2, "得意技術"), (10, 7, _phrase(rng, 3)),
+              (11, 2, "得意業務"), (11, 7, _phrase(rng, 2)),
+              (13, 2, "自己PR"), (13, 7, "。".join(_phrase(rng, 6) for _ in range(5)) + "。"),
+              (15, 2, "＜業務経歴＞"),
+              (16, 2, "No"), (16, 3, "期間"), (16, 12, "業務内容"), (16, 34, "役割 規模"),
+              (16, 40, "言語/OS/環境"), (16, 49, "担当工程")]
+    cells += [(17, 49 + i, p) for i, p in enumerate(_PHASES)]
+    start = date(2025, 1, 1)
+    row = 18
+    for no in range(1, n_projects + 1):
+        end = start - timedelta(days=rng.randint(0, 30))
+        start = end - timedelta(days=rng.randint(60, 720))
+        cells += [(row, 2, no), (row, 3, datetime(start.year, start.month, 1)), (row, 7, "－"),
+                  (row, 8, datetime(end.year, end.month, 1)), (row, 12, "◆" + _phrase(rng, 2)),
+                  (row, 34, f"メンバー {rng.choice(['PG', 'SE', 'PL'])} {rng.randint(3, 60)}名"),
+                  (row, 40, " ".join(rng.choice(_WORDS[22:]) for _ in range(6))),
+                  (row + 1, 12, "【担当業務】\n・" + "\n・".join(_phrase(rng, 4) for _ in range(4))),
+                  (row + 4, 3, rng.randint(1, 24))]
+        cells += [(row, 49 + i, "●") for i in range(len(_PHASES)) if rng.random() < 0.5]
+        row += 5
+    return cells
+
+def _grid_cells(rng: random.Random, rows: int, cols: int, fill: float) -> List[tuple]:
+    cells = []
+    for r in range(1, rows + 1):
+        for c in range(1, cols + 1):
+            if rng.random() >= fill:
+                continue
+            kind = rng.random()
+            if kind < 0.4:
+                v = rng.randint(0, 100000)
+            elif kind < 0.55:
+                v = round(rng.uniform(-1000, 1000), 4)
+            elif kind < 0.6:
+                v = datetime(2020, 1, 1) + timedelta(days=rng.randint(0, 2000), seconds=rng.randint(0, 86399))
+            else:
+                v = _phrase(rng, rng.randint(1, 3))
+            cells.append((r, c, v))
+    return cells
+
+def _unique_string_cells(rng: random.Random, first_row: int, rows: int, cols: int) -> List[tuple]:
+    # 共有文字列表を大きくするための一意な文字列（抽出範囲の外側に置く）
+    return [(r, c, f"{rng.choice(_WORDS)}-{r}-{c}-{rng.getrandbits(32):08x}")
+            for r in range(first_row, first_row + rows) for c in range(1, cols + 1)]
+
+_FIXED_TIME = datetime(2025, 1, 1)
+
+def _xlsx(cells: List[tuple], title: str = "Sheet1") -> bytes:
+    wb = Workbook()
+    wb.properties.created = _FIXED_TIME
+    ws = wb.active
+    ws.title = title
+    for r, c, v in cells:
+        ws.cell(row=r, column=c, value=v)
+    buf = BytesIO()
+    wb.save(buf)
+    # 保存時刻（core.xml の modified と zip のエントリ時刻）を固定して、同じ seed なら同じバイト列にする
+    wb.properties.modified = _FIXED_TIME
+    out = BytesIO()
+    with zipfile.ZipFile(BytesIO(buf.getvalue())) as src, zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as dst:
+        for info in src.infolist():
+            data = tostring(wb.properties.to_tree()) if info.filename == ARC_CORE else src.read(info)
+            dst.writestr(zipfile.ZipInfo(info.filename, _FIXED_TIME.timetuple()[:6]), data,
+                         compress_type=zipfile.ZIP_DEFLATED)
+    return out.getvalue()
+
+def _xls(cells: List[tuple], title: str = "Sheet1") -> bytes:
+    wb = xlwt.Workbook(encoding="utf-8")
+    ws = wb.add_sheet(title)
+    date_style = xlwt.easyxf(num_format_str="yyyy/mm/dd")
+    for r, c, v in cells:
+        if isinstance(v, datetime):
+            ws.write(r - 1, c - 1, v, date_style)
+        else:
+            ws.write(r - 1, c - 1, v)
+    buf = BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+def _eml(rng: random.Random, attachments: List[tuple], html_only: bool = False) -> bytes:
+    from email.message import EmailMessage
+    m = EmailMessage()
+    m["From"] = "sender@example.com"
+    m["To"] = "recruit@example.com"
+    m["Subject"] = "スキルシート送付の件"
+    text = "\n".join(_phrase(rng, 5) for _ in range(10))
+    if html_only:
+        m.set_content("<html><body>" + "".join(f"<p>{line}</p>" for line in text.split("\n")) + "</body></html>",
+                      subtype="html")
+    else:
+        m.set_content(text)
+    for name, data in attachments:
+        if name.endswith(".xls"):
+            maintype, subtype = "application", "vnd.ms-excel"
+        else:
+            maintype, subtype = "application", "vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        m.add_attachment(data, maintype=maintype, subtype=subtype, filename=name)
+    if m.is_multipart():
+        m.set_boundary(f"bench-boundary-{rng.getrandbits(64):016x}")  # 既定の境界文字列は実行ごとに変わる
+    return m.as_bytes()
+
+# --- .msg（OLE2 複合ファイル）の最小限のライター ---
+
+_ENDOFCHAIN, _FREESECT, _FATSECT, _NOSTREAM = 0xFFFFFFFE, 0xFFFFFFFF, 0xFFFFFFFD, 0xFFFFFFFF
+
+def _cfb(tree: Dict) -> bytes:
+    # tree: {名前: bytes | dict}（dict はストレージ）。512 バイトセクタ、4096 未満のストリームはミニストリームへ
+    entries = [{"name": "Root Entry", "type": 5, "children": []}]
+
+    def add(node, parent):
+        for name, val in node.items():
+            idx = len(entries)
+            entries[parent]["children"].append(idx)
+            if isinstance(val, dict):
+                entries.append({"name": name, "type": 1, "children": []})
+                add(val, idx)
+            else:
+                entries.append({"name": name, "type": 2, "children": [], "data": bytes(val)})
+
+    add(tree, 0)
+    for e in entries:
+        e.update(left=_NOSTREAM, right=_NOSTREAM, child=_NOSTREAM, start=_ENDOFCHAIN, size=0)
+
+    def balanced(ids):
+        if not ids:
+            return _NOSTREAM
+        mid = len(ids) // 2
+        entries[ids[mid]]["left"] = balanced(ids[:mid])
+        entries[ids[mid]]["right"] = balanced(ids[mid + 1:])
+        return ids[mid]
+
+    for e in entries:
+        if e["type"] != 2:
+            e["child"] = balanced(sorted(e["children"], key=lambda i: (len(entries[i]["name"]),
+                                                                       entries[i]["name"].upper())))
+
+    mini, minifat, big = bytearray(), [], []
+    for i, e in enumerate(entries):
+        if e["type"] != 2:
+            continue
+        d = e["data"]
+        e["size"] = len(d)
+        if not d:
+            continue
+        if len(d) < 4096:
+            n = -(-len(d) // 64)
+            e["start"] = len(minifat)
+            minifat += [len(minifat) + k + 1 for k in range(n - 1)] + [_ENDOFCHAIN]
+            mini += d + b"\0" * (n * 64 - len(d))
+        else:
+            big.append(i)
+
+    nsec = lambda n: -(-n // 512)
+    dir_secs, minifat_secs, mini_secs = nsec(len(entries) * 128), nsec(len(minifat) * 4), nsec(len(mini))
+    big_secs = sum(nsec(entries[i]["size"]) for i in big)
+    fat_secs = 1
+    while nsec((fat_secs + dir_secs + minifat_secs + mini_secs + big_secs) * 4) > fat_secs:
+        fat_secs += 1
+    if fat_secs > 109:
+        raise ValueError("compound file too large for this writer")
+
+    fat: List[int] = [_FATSECT] * fat_secs
+
+    def chain(count):
+        start = len(fat)
+        fat.extend([start + k + 1 for k in range(count - 1)] + [_ENDOFCHAIN] if count else [])
+        return start if count else _ENDOFCHAIN
+
+    dir_start, minifat_start, mini_start = chain(dir_secs), chain(minifat_secs), chain(mini_secs)
+    for i in big:
+        entries[i]["start"] = chain(nsec(entries[i]["size"]))
+    entries[0]["start"], entries[0]["size"] = (mini_start if mini else _ENDOFCHAIN), len(mini)
+
+    pad = lambda b: bytes(b) + b"\0" * (-len(b) % 512)
+    out = bytearray(pad(struct.pack(f"<{len(fat)}I", *fat) + struct.pack("<I", _FREESECT) * (fat_secs * 128 - len(fat))))
+    dir_bytes = bytearray()
+    for e in entries:
+        name = e["name"].encode("utf-16-le") + b"\0\0"
+        dir_bytes += (name.ljust(64, b"\0") + struct.pack("<HBB", len(name), e["type"], 1)
+                      + struct.pack("<III", e["left"], e["right"], e["child"]) + b"\0" * 36
+                      + struct.pack("<IQ", e["start"], e["size"]))
+    while len(dir_bytes) % 512:
+        dir_bytes += b"\0" * 64 + struct.pack("<HBBIII", 0, 0, 0, _NOSTREAM, _NOSTREAM, _NOSTREAM) + b"\0" * 48
+    out += dir_bytes
+    if minifat:
+        out += pad(struct.pack(f"<{len(minifat)}I", *minifat) + struct.pack("<I", _FREESECT) * (-len(minifat) % 128))
+    if mini:
+        out += pad(mini)
+    for i in big:
+        out += pad(entries[i]["data"])
+
+    header = (b"\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1" + b"\0" * 16
+              + struct.pack("<HHHHH", 0x3E, 3, 0xFFFE, 9, 6) + b"\0" * 6
+              + struct.pack("<IIIIIIIII", 0, fat_secs, dir_start, 0, 4096,
+                            minifat_start if minifat else _ENDOFCHAIN, minifat_secs, _ENDOFCHAIN, 0)
+              + struct.pack("<109I", *(list(range(fat_secs)) + [_FREESECT] * (109 - fat_secs))))
+    return header + bytes(out)
+
+def _msg(rng: random.Random, attachments: List[tuple], html_only: bool = False) -> bytes:
+    u = lambda s: s.encode("utf-16-le")
+    text = "\n".join(_phrase(rng, 5) for _ in range(10))
+    props = bytearray(struct.pack("<QIIII", 0, 0, len(attachments), 0, len(attachments)) + b"\0" * 8)
+    props += struct.pack("<IIQ", 0x340D0003, 6, 0x00040000)  # PR_STORE_SUPPORT_MASK: Unicode 文字列
+    tree = {
+        "__substg1.0_001A001F": u("IPM.Note"),
+        "__substg1.0_0037001F": u("スキルシート送付の件"),
+        "__nameid_version1.0": {"__substg1.0_00020102": b"", "__substg1.0_00030102": b"",
+                                "__substg1.0_00040102": b""},
+    }
+    if html_only:
+        tree["__substg1.0_10130102"] = ("<html><body>" + "".join(f"<p>{line}</p>" for line in text.split("\n"))
+                                        + "</body></html>").encode("utf-8")
+    else:
+        tree["__substg1.0_1000001F"] = u(text)
+    for i, (name, data) in enumerate(attachments):
+        aprops = b"\0" * 8 + struct.pack("<IIQ", 0x37050003, 6, 1)  # PR_ATTACH_METHOD = ATTACH_BY_VALUE
+        tree["__attach_version1.0_#%08X" % i] = {
+            "__substg1.0_3707001F": u(name),
+            "__substg1.0_3704001F": u(name[:12]),
+            "__substg1.0_37010102": data,
+            "__properties_version1.0": aprops,
+        }
+    tree["__properties_version1.0"] = bytes(props)
+    return _cfb(tree)
+
+def build_corpus(seed: int = 0) -> Dict[str, tuple]:
+    """{コーパス名: (ファイル名, bytes)}。同じ seed なら同じ内容になる"""
+    rng = random.Random(seed)
+    books: Dict[str, tuple] = {}
+    sample = os.path.join(HERE, SAMPLE_XLSX)
+    if os.path.exists(sample):
+        with open(sample, "rb") as f:
+            books["xlsx_sample"] = ("sample.xlsx", f.read())
+    skill = _skill_sheet_cells(rng, 8)
+    books["xlsx_skill"] = ("skill.xlsx", _xlsx(skill, "スキルシート"))
+    books["xlsx_sparse"] = ("sparse.xlsx", _xlsx(_grid_cells(rng, 200, 50, 0.03)))
+    books["xlsx_dense"] = ("dense.xlsx", _xlsx(_grid_cells(rng, 200, 50, 1.0)))
+    books["xlsx_big_sst"] = ("big_sst.xlsx", _xlsx(_grid_cells(rng, 200, 20, 0.5)
+                                                   + _unique_string_cells(rng, 201, 10000, 10)))
+    if xlwt is not None:
+        books["xls_skill"] = ("skill.xls", _xls(skill, "スキルシート"))
+        books["xls_dense"] = ("dense.xls", _xls(_grid_cells(rng, 200, 50, 1.0)))
+
+    corpus = dict(books)
+    attachable = [v for k, v in books.items() if k in ("xlsx_skill", "xlsx_sparse", "xls_skill")]
+    for n in (0, 1, 3, 10):
+        atts = [(f"{i:02d}_{attachable[i % len(attachable)][0]}", attachable[i % len(attachable)][1])
+                for i in range(n)]
+        corpus[f"eml_{n}att"] = (f"mail_{n}.eml", _eml(rng, atts))
+        corpus[f"msg_{n}att"] = (f"mail_{n}.msg", _msg(rng, atts))
+    corpus["eml_html"] = ("html.eml", _eml(rng, attachable[:1], html_only=True))
+    corpus["msg_html"] = ("html.msg", _msg(rng, attachable[:1], html_only=True))
+    return corpus
+
+# ========= 計測ケース =========
+
+def _is_book(name: str) -> bool:
+    return name.startswith(("xlsx_", "xls_"))
+
+def list_cases(corpus_names: List[str]) -> List[str]:
+    # ケース名は "<対象>:<コーパス名>"
+    books = [n for n in corpus_names if _is_book(n)]
+    cases = [f"sparse:{n}" for n in books]
+    cases += [f"normalize:{n}" for n in books]
+    cases += [f"eml:{n}" for n in corpus_names if n.startswith("eml_")]
+    cases += [f"msg:{n}" for n in corpus_names if n.startswith("msg_")]
+    cases += [f"http_extract:{n}" for n in books]
+    cases += [f"http_mail:{n}" for n in corpus_names if n.startswith(("eml_", "msg_"))]
+    if books:
+        cases.append("http_batch:all_books")
+    return cases
+
+def _case_fn(case: str, corpus: Dict[str, tuple]):
+    # 1回ぶんの処理を行う関数と、その入力バイト数を返す
+    import excel_api as E
+    target, name = case.split(":", 1)
+    if target == "http_batch":
+        items = [corpus[n] for n in corpus if _is_book(n)]
+        client = E.app.test_client()
+
+        def run():
+            r = client.post("/extract_batch", content_type="multipart/form-data",
+                            data={"file": [(BytesIO(b), fn) for fn, b in items]})
+            body = r.get_data()
+            r.close()
+            if r.status_code != 200 or body.count(b"\n") != len(items):
+                raise RuntimeError(f"/extract_batch returned {r.status_code}")
+        return run, sum(len(b) for _, b in items)
+
+    filename, data = corpus[name]
+    if target == "normalize":
+        # セル値の文字列化だけを測る（値は抽出範囲ぶんを先に読み出しておく）
+        rows = _raw_rows(filename, data, E.MAX_ROWS, E.MAX_COLS)
+        normalize = getattr(E, "_normalize_row", None) or (lambda values: [E.to_str(v) for v in values])
+
+        def run():
+            for values in rows:
+                normalize(values)
+        return run, len(data)
+    if target == "sparse":
+        return (lambda: E._excel_sparse_from_bytes(data, filename=filename)), len(data)
+    if target == "eml":
+        return (lambda: E._handle_eml_bytes(data)), len(data)
+    if target == "msg":
+        return (lambda: E._handle_msg_bytes(data)), len(data)
+
+    client = E.app.test_client()
+    path = {"http_extract": "/extract", "http_mail": "/extract_mail"}[target]
+
+    def run():
+        r = client.post(path, data={"file": (BytesIO(data), filename)}, content_type="multipart/form-data")
+        r.get_data()
+        r.close()
+        if r.status_code != 200:
+            raise RuntimeError(f"{path} returned {r.status_code}: {r.get_data()[:200]!r}")
+    return run, len(data)
+
+def _raw_rows(filename: str, data: bytes, max_rows: int, max_cols: int) -> List[list]:
+    if filename.endswith(".xls"):
+        import xlrd
+        sheet = xlrd.open_workbook(file_contents=data).sheet_by_index(0)
+        return [sheet.row_values(r, 0, min(sheet.ncols, max_cols)) for r in range(min(sheet.nrows, max_rows))]
+    from openpyxl import load_workbook
+    wb = load_workbook(BytesIO(data), data_only=True, read_only=True)
+    # xlsx の抽出では空セルは正規化の前に落ちるので、ここでも除いておく
+    return [[v for v in row if v is not None]
+            for row in wb.active.iter_rows(max_row=max_rows, max_col=max_cols, values_only=True)]
+
+def _percentile(sorted_vals: List[float], q: float) -> float:
+    if len(sorted_vals) == 1:
+        return sorted_vals[0]
+    pos = (len(sorted_vals) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_vals) - 1)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (pos - lo)
+
+def _maxrss_kb() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss  # macOS はバイト、Linux は KiB
+
+def run_case(case: str, corpus: Dict[str, tuple], min_time: float, min_iters: int, warmup: int) -> Dict:
+    fn, nbytes = _case_fn(case, corpus)
+    for _ in range(warmup):
+        fn()
+    rss_before = _maxrss_kb()
+    lat = []
+    t_start = time.perf_counter()
+    while len(lat) < min_iters or time.perf_counter() - t_start < min_time:
+        t0 = time.perf_counter()
+        fn()
+        lat.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - t_start
+    lat.sort()
+    return {
+        "iterations": len(lat),
+        "input_bytes": nbytes,
+        "mean_ms": statistics.fmean(lat) * 1000,
+        "p50_ms": _percentile(lat, 0.50) * 1000,
+        "p90_ms": _percentile(lat, 0.90) * 1000,
+        "p99_ms": _percentile(lat, 0.99) * 1000,
+        "max_ms": lat[-1] * 1000,
+        "ops_per_s": len(lat) / elapsed,
+        "mb_per_s": nbytes * len(lat) / elapsed / 1e6,
+        "peak_rss_kb": _maxrss_kb(),
+        "rss_growth_kb": _maxrss_kb() - rss_before,
+    }
+
+def _bench_env(pool_workers: int) -> Dict[str, str]:
+    # 繰り返し計測がキャッシュに当たらないよう無効化し、受付制御で待たされないようにする
+    return {"EXTRACT_CACHE_BYTES": "0", "EXTRACT_CACHE_DIR": "", "PARSE_POOL_WORKERS": str(pool_workers),
+            "ADMIT_MAX_ACTIVE": "64", "ADMIT_MAX_QUEUE": "64", "JOB_WORKERS": "0"}
+
+def _load_corpus_dir(path: str) -> Dict[str, tuple]:
+    with open(os.path.join(path, "index.json"), encoding="utf-8") as f:
+        index = json.load(f)
+    corpus = {}
+    for name, filename in index.items():
+        with open(os.path.join(path, name + "__" + filename), "rb") as f:
+            corpus[name] = (filename, f.read())
+    return corpus
+
+def write_corpus(corpus: Dict[str, tuple], path: str) -> None:
+    os.makedirs(path, exist_ok=True)
+    for name, (filename, data) in corpus.items():
+        with open(os.path.join(path, name + "__" + filename), "wb") as f:
+            f.write(data)
+    with open(os.path.join(path, "index.json"), "w", encoding="utf-8") as f:
+        json.dump({name: filename for name, (filename, _) in corpus.items()}, f, ensure_ascii=False, indent=1)
+
+# ========= 起動時間（import のコスト） =========
+# 毎回新しいプロセスで import し、その所要時間とピークRSSを測る。
+# excel_api は解析ライブラリを遅延 import するので、excel_api 単体と warm_up() 込みを並べて出す。
+
+IMPORT_CASES = {
+    "import:flask": "import flask",
+    "import:openpyxl": "import openpyxl",
+    "import:xlrd": "import xlrd",
+    "import:olefile": "import olefile",
+    "import:extract_msg": "import extract_msg",
+    "import:excel_api": "import excel_api",
+    "import:excel_api+warm_up": "import excel_api; excel_api.warm_up()",
+}
+
+_IMPORT_PROBE = """
+import sys, time, resource
+sys.path.insert(0, {here!r})
+t0 = time.perf_counter()
+{stmt}
+print(time.perf_counter() - t0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+def run_import_case(case: str, runs: int, pool_workers: int) -> Dict:
+    env = dict(os.environ, **_bench_env(pool_workers))
+    code = _IMPORT_PROBE.format(here=HERE, stmt=IMPORT_CASES[case])
+    lat, rss = [], []
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env, check=True)
+        seconds, maxrss = proc.stdout.split()
+        lat.append(float(seconds))
+        rss.append(int(maxrss) // 1024 if sys.platform == "darwin" else int(maxrss))
+    lat.sort()
+    return {
+        "iterations": runs,
+        "input_bytes": 0,
+        "mean_ms": statistics.fmean(lat) * 1000,
+        "p50_ms": _percentile(lat, 0.50) * 1000,
+        "p90_ms": _percentile(lat, 0.90) * 1000,
+        "p99_ms": _percentile(lat, 0.99) * 1000,
+        "max_ms": lat[-1] * 1000,
+        "ops_per_s": 0.0,
+        "mb_per_s": 0.0,
+        "peak_rss_kb": max(rss),
+        "rss_growth_kb": 0,
+    }
+
+# ========= 比較 =========
+
+def compare(baseline: Dict, current: Dict, threshold: float, rss_threshold: float) -> List[str]:
+    """劣化したケースの説明を返す（空なら問題なし）"""
+    regressions = []
+    base = baseline.get("results", {})
+    print(f"\n{'case':<34} {'base p50':>10} {'now p50':>10} {'ratio':>7}  {'base rss+':>10} {'now rss+':>10}")
+    for case, now in current["results"].items():
+        old = base.get(case)
+        if old is None:
+            print(f"{case:<34} {'-':>10} {now['p50_ms']:>10.2f} {'new':>7}")
+            continue
+        ratio = now["p50_ms"] / old["p50_ms"] if old["p50_ms"] else float("inf")
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = "  SLOWER"
+            regressions.append(f"{case}: p50 {old['p50_ms']:.2f}ms -> {now['p50_ms']:.2f}ms (x{ratio:.2f})")
+        grow_old, grow_now = old.get("rss_growth_kb", 0), now.get("rss_growth_kb", 0)
+        if grow_now - grow_old > RSS_NOISE_KB and grow_now > grow_old * (1 + rss_threshold):
+            mark += "  MORE-RSS"
+            regressions.append(f"{case}: RSS growth {grow_old}KiB -> {grow_now}KiB")
+        print(f"{case:<34} {old['p50_ms']:>10.2f} {now['p50_ms']:>10.2f} {ratio:>7.2f}  "
+              f"{grow_old:>10} {grow_now:>10}{mark}")
+    for case in base:
+        if case not in current["results"]:
+            print(f"{case:<34} (not run)")
+    return regressions
+
+# ========= main =========
+
+def _print_result(case: str, r: Dict) -> None:
+    print(f"{case:<34} {r['iterations']:>6} {r['p50_ms']:>9.2f} {r['p90_ms']:>9.2f} {r['p99_ms']:>9.2f} "
+          f"{r['ops_per_s']:>9.1f} {r['mb_per_s']:>8.2f} {r['peak_rss_kb'] // 1024:>7}", flush=True)
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="excel_api benchmark")
+    ap.add_argument("-k", "--filter", action="append", default=[], help="ケース名の部分一致（複数指定可）")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--min-time", type=float, default=1.0, help="1ケースあたりの最短計測時間（秒）")
+    ap.add_argument("--min-iters", type=int, default=5)
+    ap.add_argument("--warmup", type=int, default=1)
+    ap.add_argument("--pool-workers", type=int, default=0, help="PARSE_POOL_WORKERS（0 で解析を同一プロセスで実行）")
+    ap.add_argument("--no-isolate", action="store_true", help="全ケースを同じプロセスで実行する")
+    ap.add_argument("--save", metavar="JSON", help="結果をベースラインとして保存")
+    ap.add_argument("--compare", metavar="JSON", help="ベースラインと比較し、劣化があれば終了コード 1")
+    ap.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="p50 の許容悪化率")
+    ap.add_argument("--rss-threshold", type=float, default=DEFAULT_RSS_THRESHOLD, help="RSS 増分の許容悪化率")
+    ap.add_argument("--list", action="store_true", help="ケース名を表示して終了")
+    ap.add_argument("--write-corpus", metavar="DIR", help="コーパスを書き出して終了")
+    ap.add_argument("--imports", action="store_true", help="import のコストを計測する（--min-iters 回の中央値）")
+    ap.add_argument("--corpus-dir", help=argparse.SUPPRESS)  # 子プロセス用
+    ap.add_argument("--run-case", help=argparse.SUPPRESS)    # 子プロセス用
+    args = ap.parse_args(argv)
+
+    if args.run_case:
+        os.environ.update(_bench_env(args.pool_workers))
+        sys.path.insert(0, HERE)
+        result = run_case(args.run_case, _load_corpus_dir(args.corpus_dir),
+                          args.min_time, args.min_iters, args.warmup)
+        print(json.dumps(result))
+        return 0
+
+    if args.imports:
+        cases = [c for c in IMPORT_CASES if not args.filter or any(k in c for k in args.filter)]
+        print(f"{'case':<34} {'runs':>6} {'p50 ms':>9} {'p90 ms':>9} {'max ms':>9} {'RSS MiB':>7}")
+        results = {}
+        for case in cases:
+            r = results[case] = run_import_case(case, args.min_iters, args.pool_workers)
+            print(f"{case:<34} {r['iterations']:>6} {r['p50_ms']:>9.2f} {r['p90_ms']:>9.2f} {r['max_ms']:>9.2f} "
+                  f"{r['peak_rss_kb'] // 1024:>7}", flush=True)
+        return _finish(args, results)
+
+    corpus = build_corpus(args.seed)
+    if args.write_corpus:
+        write_corpus(corpus, args.write_corpus)
+        print(f"wrote {len(corpus)} files to {args.write_corpus}")
+        return 0
+    cases = [c for c in list_cases(list(corpus)) if not args.filter or any(k in c for k in args.filter)]
+    if args.list:
+        print("\n".join(cases))
+        return 0
+    if xlwt is None:
+        print("note: xlwt is not installed; .xls cases are skipped", file=sys.stderr)
+
+    print(f"{'case':<34} {'iters':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'ops/s':>9} {'MB/s':>8} {'RSS MiB':>7}")
+    results = {}
+    if args.no_isolate:
+        os.environ.update(_bench_env(args.pool_workers))
+        sys.path.insert(0, HERE)
+        for case in cases:
+            results[case] = run_case(case, corpus, args.min_time, args.min_iters, args.warmup)
+            _print_result(case, results[case])
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            write_corpus(corpus, tmp)
+            for case in cases:
+                cmd = [sys.executable, os.path.abspath(__file__), "--run-case", case, "--corpus-dir", tmp,
+                       "--min-time", str(args.min_time), "--min-iters", str(args.min_iters),
+                       "--warmup", str(args.warmup), "--pool-workers", str(args.pool_workers)]
+                proc = subprocess.run(cmd, capture_output=True, text=True)
+                if proc.returncode != 0:
+                    print(f"{case:<34} FAILED\n{proc.stderr.strip()}", file=sys.stderr)
+                    continue
+                results[case] = json.loads(proc.stdout.strip().splitlines()[-1])
+                _print_result(case, results[case])
+    return _finish(args, results)
+
+def _finish(args, results: Dict) -> int:
+    # 結果の保存とベースライン比較（--imports の結果も同じ形式）
+    current = {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": args.seed,
+            "min_time": args.min_time,
+            "pool_workers": args.pool_workers,
+            "isolated": not args.no_isolate,
+        },
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(current, f, ensure_ascii=False, indent=1)
+        print(f"\nsaved baseline to {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current, args.threshold, args.rss_threshold)
+        if regressions:
+            print("\nregressions:\n  " + "\n  ".join(regressions))
+            return 1
+        print("\nno regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -268,20 +268,32 @@
 
 
 # excel_api.py
-import os, json, re, html, tempfile
+import os, json, re, html, tempfile, zipfile, posixpath, hashlib, sys, threading, time, functools, itertools, operator
+import mmap, multiprocessing, signal, bisect, datetime, binascii, struct, secrets, resource, gc, importlib, sqlite3
+from array import array
+from contextlib import contextmanager, closing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
 from typing import List, Dict
+from xml.etree import ElementTree as ET
 
-from flask import Flask, request, jsonify, Response
-from openpyxl import load_workbook
-import xlrd  # ← .xls対応
+from flask import Flask, request, jsonify, Response, g
+from werkzeug.exceptions import RequestEntityTooLarge
 
-# .msg用
-import extract_msg  # pip install extract-msg
+# 解析ライブラリ（openpyxl / xlrd / extract-msg / olefile）は起動を軽くするため、使う関数の中で import する。
+# 先に読み込んでおきたいときは warm_up() を呼ぶ（下の「起動時の準備」を参照）
 
 # .eml用（標準ライブラリ）
 from email import policy
-from email.parser import BytesParser
+from email.parser import BytesHeaderParser
+
+# MessagePack 出力用（任意）。入っていなければ format=msgpack は 406 を返す
+try:
+    import msgpack  # pip install msgpack
+except ImportError:
+    msgpack = None
 
 app = Flask(__name__)
 
@@ -289,29 +301,290 @@ app = Flask(__name__)
 MAX_ROWS = 200
 MAX_COLS = 50
 MAX_NONEMPTY = 2000  # 非空セルの最大数（安全弁）
+MAX_NONEMPTY_PER_SHEET = max(int(os.environ.get("MAX_NONEMPTY_PER_SHEET", "1000")), 1)  # 複数シート抽出時の1シートあたり上限
+
+# xlsx をシートXMLの逐次パースで読む（false で openpyxl 直読みに戻す）
+XLSX_STREAMING = os.environ.get("XLSX_STREAMING", "true").lower() != "false"
+
+# 非空セルの割合がこれ以上のシート（表のエクスポートなど）は、空セルを含めた行全体をまとめて正規化する（.xls / openpyxl）
+DENSE_SHEET_THRESHOLD = float(os.environ.get("DENSE_SHEET_THRESHOLD", "0.5"))
+
+# 抽出結果キャッシュ（ファイル内容のハッシュ + シート指定 + 上限値 がキー）
+EXTRACT_CACHE_BYTES = int(os.environ.get("EXTRACT_CACHE_BYTES", str(64 * 1024 * 1024)))  # 0 で無効
+EXTRACT_CACHE_DIR = os.environ.get("EXTRACT_CACHE_DIR", "")  # 指定時のみディスク層を使う（ワーカー間で共有）
+EXTRACT_CACHE_DISK_BYTES = int(os.environ.get("EXTRACT_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+
+# 解析用プロセスプールの大きさ（0 でプロセスプールを使わず順次処理）。旧名 MAIL_POOL_WORKERS も読む
+PARSE_POOL_WORKERS = int(os.environ.get("PARSE_POOL_WORKERS",
+                                        os.environ.get("MAIL_POOL_WORKERS", str(os.cpu_count() or 1))))
+ATTACHMENT_TIMEOUT = float(os.environ.get("ATTACHMENT_TIMEOUT", "30"))  # 添付1件あたりの待ち時間上限（秒）
+
+# 受付制御：同時に解析するリクエスト数と、その後ろで待てる数。溢れたら 429 を返す
+ADMIT_MAX_ACTIVE = int(os.environ.get("ADMIT_MAX_ACTIVE", str(max(PARSE_POOL_WORKERS, 1))))
+ADMIT_MAX_QUEUE = int(os.environ.get("ADMIT_MAX_QUEUE", str(max(PARSE_POOL_WORKERS, 1) * 2)))
+ADMIT_QUEUE_TIMEOUT = float(os.environ.get("ADMIT_QUEUE_TIMEOUT", "30"))  # 待ち行列での最大待ち時間（秒）
+
+# /extract_batch で1リクエストに受け付けるファイル数
+MAX_BATCH_FILES = int(os.environ.get("MAX_BATCH_FILES", "1000"))
+
+# ブックのセッション（/workbooks）：最後の参照からの有効期間（秒）、索引の合計上限、1ブックで索引に載せるセル数
+SESSION_TTL = float(os.environ.get("SESSION_TTL", "1800"))
+SESSION_MAX_BYTES = int(os.environ.get("SESSION_MAX_BYTES", str(256 * 1024 * 1024)))
+SESSION_MAX_CELLS = max(int(os.environ.get("SESSION_MAX_CELLS", "1000000")), 1)
+
+# 非同期ジョブ（/jobs）：キュー（SQLite）と入出力ファイルの置き場所、1プロセスあたりの処理スレッド数（既定 0 で無効）、
+# 終わったジョブを残す時間（秒）、ジョブ1件の解析時間の上限（秒。同期の PARSE_TIMEOUT / ATTACHMENT_TIMEOUT / REQUEST_TIMEOUT の代わり）
+JOBS_DIR = os.environ.get("JOBS_DIR", os.path.join(tempfile.gettempdir(), "excel_api_jobs"))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "0"))
+JOB_TTL = float(os.environ.get("JOB_TTL", "86400"))
+JOB_TIMEOUT = float(os.environ.get("JOB_TIMEOUT", "1800"))
+
+# メール本文が HTML のみの場合に、テキスト化して返す最大文字数（0 で無制限）
+HTML_TEXT_MAX_CHARS = int(os.environ.get("HTML_TEXT_MAX_CHARS", "200000"))
+
+# .xls / .msg はメモリ上で直接読む。これを超えるサイズだけ一時ファイル + mmap に逃がす
+SPOOL_THRESHOLD = int(os.environ.get("SPOOL_THRESHOLD", str(64 * 1024 * 1024)))
+
+# 1リクエストで使える資源の上限。超えたら解析の途中でも打ち切って 413 を返す（どれも 0 で無効）
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(100 * 1024 * 1024)))  # リクエスト本体
+ZIP_MAX_MEMBER_BYTES = int(os.environ.get("ZIP_MAX_MEMBER_BYTES", str(512 * 1024 * 1024)))  # zip の1メンバーの展開後サイズ
+ZIP_MAX_RATIO = float(os.environ.get("ZIP_MAX_RATIO", "200"))  # zip の1メンバーの圧縮率（展開後 / 圧縮後）
+ZIP_MAX_TOTAL_BYTES = int(os.environ.get("ZIP_MAX_TOTAL_BYTES", str(256 * 1024 * 1024)))  # zip 1つから取り出すメンバーの展開後サイズの合計
+MAIL_MAX_ATTACHMENTS = int(os.environ.get("MAIL_MAX_ATTACHMENTS", "100"))  # メール1通の添付数（入れ子の添付も数える）
+MAIL_MAX_DEPTH = int(os.environ.get("MAIL_MAX_DEPTH", "5"))  # 添付の中のメール / zip を開く深さ（0 で最上位の添付のみ。.eml にそのまま入った message/rfc822 は対象外で、常に中まで見る）
+PARSE_TIMEOUT = float(os.environ.get("PARSE_TIMEOUT", "60"))  # 解析1回（ブック1つ、メールの読み込み1回）の時間（秒）。プールのワーカー内で打ち切る
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", "120"))  # 1リクエストの解析全体の締め切り（秒）。受付後から数え、各解析の時間はこの残りまでに縮める
+PARSE_MAX_MEMORY = int(os.environ.get("PARSE_MAX_MEMORY", str(2 * 1024 * 1024 * 1024)))  # 解析ワーカー1プロセスのアドレス空間
+
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES or None
+
+# import 時に解析ライブラリを読み込んでおく（gunicorn --preload でマスターに載せてワーカーと共有する）
+PRELOAD_BACKENDS = os.environ.get("PRELOAD_BACKENDS", "false").lower() == "true"
+
+# ========= セル値の正規化 =========
+# 型ごとに変換関数を分け、数値・日付は str() を1回呼ぶだけにする。
+# 文字列は改行・タブ・_x000D_ を含むときだけ置換する（出力は従来の to_str と同じ）。
+
+def _norm_text(s: str) -> str:
+    if "\n" in s or "\r" in s or "\t" in s or "_x000D_" in s:
+        s = (s.replace("_x000D_", " ")
+              .replace("\t", " ")
+              .replace("\r\n", " ")
+              .replace("\n", " ")
+              .replace("\r", " "))
+    return s.strip()
+
+def _norm_float(v: float) -> str:
+    # 整数値の float（xlrd の数値は常に float）は 36.0 ではなく 36 と出す。指数表記になる大きさはそのまま
+    if v.is_integer() and -1e16 < v < 1e16:
+        return str(int(v))
+    return repr(v)
+
+_NORMALIZERS = {
+    str: _norm_text,
+    int: str,
+    bool: str,
+    float: _norm_float,
+    datetime.datetime: str,
+    datetime.date: str,
+    datetime.time: str,
+    datetime.timedelta: str,
+    type(None): lambda v: "",
+}
+
+# 構造化出力（json / ndjson / msgpack）で値に添える型。s: 文字列, n: 数値, b: 真偽値, d: 日付・時刻
+_CELL_TYPES = {
+    str: "s",
+    int: "n",
+    float: "n",
+    bool: "b",
+    datetime.datetime: "d",
+    datetime.date: "d",
+    datetime.time: "d",
+    datetime.timedelta: "d",
+}
 
 def to_str(v) -> str:
-    if v is None:
-        return ""
-    s = str(v)
-    return (
-        s.replace("_x000D_", " ")
-         .replace("\t", " ")
-         .replace("\r\n", " ")
-         .replace("\n", " ")
-         .replace("\r", " ")
-         .strip()
-    )
-
-def _html_to_text(html_s: str) -> str:
+    f = _NORMALIZERS.get(type(v))
+    if f is None:
+        return _norm_text(str(v))
+    return f(v)
+
+def _normalize_row(values) -> List[str]:
+    # 1行ぶんの値をまとめて文字列にする。制御文字も _x000D_ も含まない文字列（大半のセル）は strip だけで済ませる
+    get = _NORMALIZERS.get
+    return [(v.strip() if v.isprintable() and "_x000D_" not in v else _norm_text(v)) if type(v) is str
+            else "" if v is None
+            else get(type(v), to_str)(v)
+            for v in values]
+
+# ========= HTML 本文のテキスト化 =========
+# コメントと script / style を find / search で読み飛ばし、その間の部分を 64KB 程度の窓に切って
+# タグ除去（ブロック要素は改行）と実体参照の展開をする。どのパターンも '<' から次の '<' か '>' までしか
+# 見ないので、閉じないタグやコメントがあっても線形時間。上限文字数に達したらそこで読むのをやめる。
+
+_HTML_WINDOW = 64 * 1024
+_HTML_SKIP_RE = re.compile(r"<!--|<(script|style)\b", re.IGNORECASE)
+_HTML_RAWTEXT_END = {
+    "script": re.compile(r"</script\s*>", re.IGNORECASE),
+    "style": re.compile(r"</style\s*>", re.IGNORECASE),
+}
+# 改行にするのは <br> とブロック要素の閉じタグだけで、直後のソース上の改行1つはまとめて1つにする
+# （開きタグも改行にしたり、</div> の後の改行を残したりすると、to_str で空白が2つ並ぶ）
+_HTML_BLOCK_RE = re.compile(
+    r"(?:<br\b[^<>]*>|</(?:address|article|aside|blockquote|dd|div|dl|dt|footer|h[1-6]|header|li|ol|p|pre"
+    r"|section|table|td|th|title|tr|ul)\s*>)[ \t]*(?:\r\n|\n|\r)?", re.IGNORECASE)
+_HTML_TAG_RE = re.compile(r"<[^<>]*>")
+
+def _html_to_text(html_s: str, max_chars: int = 0) -> str:
+    # max_chars > 0 なら、その文字数ぶんのテキストが得られた時点で打ち切る
     if not html_s:
         return ""
-    s = re.sub(r'(?is)<(script|style).*?>.*?</\1>', '', html_s)
-    s = re.sub(r'(?is)<br\s*/?>', '\n', s)
-    s = re.sub(r'(?is)</p\s*>', '\n', s)
-    s = re.sub(r'(?is)<.*?>', '', s)
-    s = html.unescape(s)
-    return to_str(s)
+    out: List[str] = []
+    size = 0
+    pos, n = 0, len(html_s)
+    while pos < n:
+        skip = _HTML_SKIP_RE.search(html_s, pos)
+        seg_end = n if skip is None else skip.start()
+        while pos < seg_end:
+            # 窓の境目は '>' の直後に置き、タグを途中で切らない（この先に '>' が無ければどこで切っても同じ）
+            cut = min(pos + _HTML_WINDOW, seg_end)
+            gt = html_s.find(">", cut, seg_end)
+            if gt >= 0:
+                cut = gt + 1
+            piece = _HTML_TAG_RE.sub("", _HTML_BLOCK_RE.sub("\n", html_s[pos:cut]))
+            if "&" in piece:
+                piece = html.unescape(piece)
+            out.append(piece)
+            size += len(piece)
+            pos = cut
+            if max_chars and size >= max_chars:
+                text = to_str("".join(out))
+                return text[:max_chars]
+        if skip is None:
+            break
+        if skip.group(1) is None:
+            close = html_s.find("-->", skip.end())
+            pos = n if close < 0 else close + 3
+        else:
+            close_m = _HTML_RAWTEXT_END[skip.group(1).lower()].search(html_s, skip.end())
+            pos = n if close_m is None else close_m.end()
+    return to_str("".join(out))
+
+_HTML_CHARSET_RE = re.compile(rb'charset\s*=\s*["\']?([A-Za-z0-9_.:-]+)', re.IGNORECASE)
+
+def _decode_html_bytes(b: bytes) -> str:
+    m = _HTML_CHARSET_RE.search(b[:2048])
+    try:
+        return b.decode(m.group(1).decode("ascii") if m else "utf-8", errors="replace")
+    except LookupError:
+        return b.decode("utf-8", errors="replace")
+
+# ========= リソース上限（zip 爆弾・添付数） =========
+# zip は中央ディレクトリの申告サイズで判定する。zipfile は申告サイズを超えて展開しないので、
+# ここを通れば展開後の大きさは読む前に決まる。アーカイブとして開く zip（/extract_batch、メールの添付）は
+# 取り出すメンバーを先に選び、その数と展開後サイズの合計も読む前に確かめる。時間とメモリの上限は解析プロセスプールの側で掛ける。
+# ブックの解析に加えて、メールの読み込みと入れ子の添付（メール / zip）の展開、stream=true の解析もプールで行う。
+# 時間は解析1回ごとの上限（PARSE_TIMEOUT / ATTACHMENT_TIMEOUT）に加えて、リクエスト全体の締め切り（REQUEST_TIMEOUT、
+# ジョブは JOB_TIMEOUT）を掛ける。メールの読み込み、添付の解析、壊れたプールでの再投入は同じ締め切りを分け合う。
+# プールを使わない設定（PARSE_POOL_WORKERS=0）では時間とメモリの上限は掛からない。
+# アップロード本体の受け取りと /extract_batch の zip からの取り出しはリクエストのスレッドで行い、サイズの上限だけが掛かる。
+
+class _BudgetExceeded(Exception):
+    pass
+
+_ZIP_RATIO_MIN_BYTES = 1024 * 1024  # これより小さいメンバーは圧縮率を問わない
+
+def _check_zip_members(zf: zipfile.ZipFile, picked: List[zipfile.ZipInfo] | None = None) -> None:
+    # picked: これから取り出すメンバー。指定されたときは展開後サイズの合計も確かめる
+    if picked is not None and ZIP_MAX_TOTAL_BYTES:
+        total = sum(info.file_size for info in picked)
+        if total > ZIP_MAX_TOTAL_BYTES:
+            raise _BudgetExceeded(f"zip members expand to {total} bytes in total (max {ZIP_MAX_TOTAL_BYTES})")
+    for info in zf.infolist():
+        size = info.file_size
+        if ZIP_MAX_MEMBER_BYTES and size > ZIP_MAX_MEMBER_BYTES:
+            raise _BudgetExceeded(f"zip member {info.filename} expands to {size} bytes (max {ZIP_MAX_MEMBER_BYTES})")
+        if ZIP_MAX_RATIO and size > _ZIP_RATIO_MIN_BYTES and size > info.compress_size * ZIP_MAX_RATIO:
+            raise _BudgetExceeded(f"zip member {info.filename} compression ratio "
+                                  f"{size / max(info.compress_size, 1):.0f} exceeds {ZIP_MAX_RATIO:g}")
+
+def _check_xlsx_budget(data: bytes) -> None:
+    try:
+        with zipfile.ZipFile(BytesIO(data)) as zf:
+            _check_zip_members(zf)
+    except zipfile.BadZipFile:
+        pass  # 壊れたブックは従来どおり読み手側のエラーにする
+
+def _check_attachment_count(n: int) -> None:
+    if MAIL_MAX_ATTACHMENTS and n > MAIL_MAX_ATTACHMENTS:
+        raise _BudgetExceeded(f"too many attachments: {n} (max {MAIL_MAX_ATTACHMENTS})")
+
+_deadline_local = threading.local()  # このスレッドで処理中のリクエスト（ジョブ）の締め切り
+
+def _set_deadline(seconds: float, reason: str = "") -> None:
+    # seconds <= 0 で締め切りなし。reason は締め切りを過ぎたときのエラー文
+    _deadline_local.at = time.monotonic() + seconds if seconds > 0 else 0.0
+    _deadline_local.reason = f"{reason} ({seconds:g}s)"
+
+def _deadline() -> float:
+    return getattr(_deadline_local, "at", 0.0)
+
+def _timeout_reason(task_reason: str) -> str:
+    # TimeoutError の原因を文にする。締め切りを過ぎていればそちらを理由にする
+    at = _deadline()
+    return _deadline_local.reason if at and time.monotonic() >= at else task_reason
+
+# ========= 入力形式の判定 =========
+# 拡張子ではなく先頭バイトで読み手を決める（attachment.bin のような名前でも1回で正しい解析器に渡す）。
+# OLE は .xls と .msg が同じ署名なので、ディレクトリのエントリ名で見分ける。
+
+_ZIP_MAGIC = b"PK\x03\x04"
+_OLE_MAGIC = b"\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1"
+_EML_FIELD_RE = re.compile(rb"[\x21-\x39\x3B-\x7E]+:")
+_EML_KNOWN_FIELD_RE = re.compile(
+    rb"^(?:from|to|subject|date|received|return-path|message-id|mime-version|content-type):",
+    re.IGNORECASE | re.MULTILINE)
+
+def _sniff_format(data: bytes) -> str | None:
+    # "zip" / "xls" / "msg" / "ole"（どちらとも決まらない OLE）/ "eml" / None（不明）
+    if data.startswith(_ZIP_MAGIC):
+        return "zip"
+    if data.startswith(_OLE_MAGIC):
+        return _ole_kind(data)
+    head = data[:4096]
+    if _EML_FIELD_RE.match(head) and _EML_KNOWN_FIELD_RE.search(head):
+        return "eml"
+    return None
+
+def _ole_kind(data: bytes) -> str:
+    # まず先頭のディレクトリセクタだけを見る。決め手が無ければ olefile でディレクトリ全体を読む
+    names = []
+    shift = struct.unpack_from("<H", data, 30)[0] if len(data) >= 52 else 0
+    if shift in (9, 12):
+        size = 1 << shift
+        start = (struct.unpack_from("<I", data, 48)[0] + 1) * size
+        for off in range(start, min(start + size, len(data)) - 127, 128):
+            n = struct.unpack_from("<H", data, off + 64)[0]
+            names.append(data[off:off + max(min(n, 64) - 2, 0)].decode("utf-16-le", "ignore"))
+    kind = _ole_kind_from_names(names)
+    if kind is None:
+        try:
+            import olefile
+            with olefile.OleFileIO(BytesIO(data)) as ole:
+                kind = _ole_kind_from_names(path[-1] for path in ole.listdir(streams=True, storages=True))
+        except Exception:
+            pass
+    return kind or "ole"
+
+def _ole_kind_from_names(names) -> str | None:
+    kind = None
+    for name in names:
+        if name.startswith("__substg1.0_") or name in ("__properties_version1.0", "__nameid_version1.0"):
+            return "msg"
+        if name.lower() in ("workbook", "book"):
+            kind = "xls"
+    return kind
 
 # ========= Excel 抽出ロジック =========
 
@@ -323,77 +596,757 @@ def _num_to_col(n: int) -> str:
         s.append(chr(65 + rem))
     return "".join(reversed(s))
 
-def _excel_sparse_from_xlsx_bytes(xlsx_bytes: bytes,
-                                  sheet_req: str | None = None,
-                                  max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY) -> str:
-    wb = load_workbook(BytesIO(xlsx_bytes), data_only=True, read_only=True)
-    ws = None
-    if sheet_req:
-        try:
-            idx = int(sheet_req)
-            names = wb.sheetnames
-            if 0 <= idx < len(names):
-                ws = wb[names[idx]]
-            elif 1 <= idx <= len(names):
-                ws = wb[names[idx - 1]]
-        except ValueError:
-            if sheet_req in wb.sheetnames:
-                ws = wb[sheet_req]
-    ws = ws or wb.active
+# 列記号の表（列番号 c の記号は _COL_LETTERS[c - 1]）。MAX_COLS までは起動時に作り、それより右の列は必要になった時に伸ばす
+_COL_LETTERS = [_num_to_col(c) for c in range(1, MAX_COLS + 1)]
+_COL_LETTERS_LOCK = threading.Lock()
+
+def _col_letter_table(n: int) -> List[str]:
+    letters = _COL_LETTERS
+    if n > len(letters):
+        with _COL_LETTERS_LOCK:
+            letters.extend(_num_to_col(c) for c in range(len(letters) + 1, n + 1))
+    return letters
+
+def _pick_sheet_index(names: List[str], sheet_req: str | None) -> int | None:
+    # 名前 / 0始まり / 1始まり。該当なしは None（呼び出し側でアクティブシート）
+    if not sheet_req:
+        return None
+    try:
+        idx = int(sheet_req)
+        if 0 <= idx < len(names):
+            return idx
+        if 1 <= idx <= len(names):
+            return idx - 1
+    except ValueError:
+        if sheet_req in names:
+            return names.index(sheet_req)
+    return None
+
+# ========= xlsx ストリーミング抽出 =========
+# zip 内のシートXMLを少しずつ伸長しながら読み、非空セルだけを拾う。
+# sharedStrings は参照された番号だけを解決し、上限に達した時点で読み込みを打ち切る。
+# 出力は openpyxl(read_only, data_only) 経由と同一になるように値の変換を合わせている。
+
+_XLSX_CHUNK = 64 * 1024
+
+# OOXML の名前空間と content type（openpyxl.xml.constants と同じ値。openpyxl を読まずに済むよう持っておく）
+ARC_CONTENT_TYPES = "[Content_Types].xml"
+ARC_STYLE = "xl/styles.xml"
+CONTYPES_NS = "http://schemas.openxmlformats.org/package/2006/content-types"
+PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+SHEET_MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+SHARED_STRINGS = "application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"
+XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"
+XLSM = "application/vnd.ms-excel.sheet.macroEnabled.main+xml"
+XLTX = "application/vnd.openxmlformats-officedocument.spreadsheetml.template.main+xml"
+XLTM = "application/vnd.ms-excel.template.macroEnabled.main+xml"
+
+_NS_MAIN = "{%s}" % SHEET_MAIN_NS
+_TAG_ROW = _NS_MAIN + "row"
+_TAG_C = _NS_MAIN + "c"
+_TAG_V = _NS_MAIN + "v"
+_TAG_IS = _NS_MAIN + "is"
+_TAG_T = _NS_MAIN + "t"
+_TAG_R = _NS_MAIN + "r"
+_TAG_SI = _NS_MAIN + "si"
+_TAG_SHEETDATA = _NS_MAIN + "sheetData"
+_COORD_RE = re.compile(r"^\$?([A-Za-z]{1,3})\$?(\d+)$")
+
+class _XlsxFallback(Exception):
+    """ストリーミングで扱えない構造。openpyxl 経由で読み直す"""
+
+def _col_to_num(letters: str) -> int:
+    n = 0
+    for ch in letters.upper():
+        n = n * 26 + (ord(ch) - 64)
+    return n
+
+def _xml_iter(src, events=("end",)):
+    parser = ET.XMLPullParser(events=events)
+    while True:
+        chunk = src.read(_XLSX_CHUNK)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+def _rich_text_content(node) -> str:
+    # openpyxl の Text.content 相当：直下の t と r/t を連結（rPh=ふりがな は除外）
+    plain = None
+    parts = []
+    for child in node:
+        if child.tag == _TAG_T:
+            plain = child.text
+        elif child.tag == _TAG_R:
+            t = child.find(_TAG_T)
+            if t is not None and t.text is not None:
+                parts.append(t.text)
+    if plain is not None:
+        parts.insert(0, plain)
+    return "".join(parts)
+
+def _xlsx_workbook_info(zf: zipfile.ZipFile) -> Dict:
+    from openpyxl.utils.datetime import WINDOWS_EPOCH, CALENDAR_MAC_1904
+    names = set(zf.namelist())
+    ct = ET.fromstring(zf.read(ARC_CONTENT_TYPES))
+    wb_types = (XLTM, XLTX, XLSM, XLSX)
+    overrides = {}
+    for el in ct.iter("{%s}Override" % CONTYPES_NS):
+        overrides.setdefault(el.get("ContentType"), el.get("PartName"))
+    wb_part = next((overrides[t] for t in wb_types if t in overrides), None)
+    if wb_part is None:
+        defaults = {el.get("ContentType") for el in ct.iter("{%s}Default" % CONTYPES_NS)}
+        if not defaults & set(wb_types):
+            raise _XlsxFallback("no workbook part")
+        wb_part = "/xl/workbook.xml"
+    wb_path = wb_part[1:]
+    sst_part = overrides.get(SHARED_STRINGS)
+
+    folder, base = posixpath.split(wb_path)
+    rels_path = posixpath.join(folder, "_rels", base + ".rels")
+    rels = {}
+    if rels_path in names:
+        for el in ET.fromstring(zf.read(rels_path)).iter("{%s}Relationship" % PKG_REL_NS):
+            target = el.get("Target") or ""
+            if el.get("TargetMode") != "External":
+                target = target[1:] if target.startswith("/") else posixpath.normpath(posixpath.join(folder, target))
+            rels[el.get("Id")] = (target, el.get("Type") or "")
+
+    root = ET.fromstring(zf.read(wb_path))
+    epoch = WINDOWS_EPOCH
+    pr = root.find(_NS_MAIN + "workbookPr")
+    if pr is not None and (pr.get("date1904") or "").lower() in ("1", "true"):
+        epoch = CALENDAR_MAC_1904
+    active = 0
+    for view in root.iter(_NS_MAIN + "workbookView"):
+        if view.get("activeTab") is not None:
+            active = int(view.get("activeTab"))
+            break
 
-    lines, count = [], 0
-    for row in ws.iter_rows(min_row=1, max_row=max_rows, min_col=1, max_col=max_cols, values_only=False):
-        for cell in row:
-            v = cell.value
-            if v is None:
+    sheets = []
+    for el in root.iter(_NS_MAIN + "sheet"):
+        rid = el.get("{%s}id" % REL_NS)
+        if not rid:
+            continue
+        target, rel_type = rels[rid]
+        if target not in names:
+            continue
+        sheets.append({"name": el.get("name"), "path": target, "chart": "chartsheet" in rel_type})
+
+    return {
+        "sheets": sheets,
+        "active": active,
+        "epoch": epoch,
+        "sst_path": sst_part[1:] if sst_part else None,
+    }
+
+def _xlsx_date_styles(zf: zipfile.ZipFile):
+    # cellXfs の並び順 = セルの s 属性。日付/時間書式のスタイル番号を集める
+    from openpyxl.styles.numbers import builtin_format_code, is_date_format, is_timedelta_format
+    date_styles, td_styles = set(), set()
+    if ARC_STYLE not in zf.namelist():
+        return date_styles, td_styles
+    root = ET.fromstring(zf.read(ARC_STYLE))
+    custom = {}
+    numfmts = root.find(_NS_MAIN + "numFmts")
+    if numfmts is not None:
+        for el in numfmts.iter(_NS_MAIN + "numFmt"):
+            custom[int(el.get("numFmtId"))] = el.get("formatCode")
+    xfs = root.find(_NS_MAIN + "cellXfs")
+    if xfs is None:
+        return date_styles, td_styles
+    for idx, xf in enumerate(xfs.iter(_NS_MAIN + "xf")):
+        fmt_id = int(xf.get("numFmtId", 0))
+        fmt = custom[fmt_id] if fmt_id in custom else builtin_format_code(fmt_id)
+        if is_date_format(fmt):
+            date_styles.add(idx)
+        if is_timedelta_format(fmt):
+            td_styles.add(idx)
+    return date_styles, td_styles
+
+def _xlsx_cell_value(el, epoch, date_styles, td_styles):
+    # 戻り値: (共有文字列番号 or None, 値)
+    data_type = el.get("t", "n")
+    if data_type == "inlineStr":
+        child = el.find(_TAG_IS)
+        return None, (_rich_text_content(child) if child is not None else None)
+    value = el.findtext(_TAG_V, None) or None
+    if value is None:
+        return None, None
+    if data_type == "n":
+        value = float(value) if ("." in value or "E" in value or "e" in value) else int(value)
+        style_id = el.get("s", 0)
+        if style_id and int(style_id) in date_styles:
+            style_id = int(style_id)
+            from openpyxl.utils.datetime import from_excel
+            try:
+                value = from_excel(value, epoch, timedelta=style_id in td_styles)
+            except (OverflowError, ValueError):
+                value = "#VALUE!"
+        return None, value
+    if data_type == "s":
+        return int(value), None
+    if data_type == "b":
+        return None, bool(int(value))
+    if data_type == "d":
+        from openpyxl.utils.datetime import from_ISO8601
+        return None, from_ISO8601(value)
+    return None, value
+
+def _xlsx_iter_rows(zf: zipfile.ZipFile, path: str, max_rows: int, max_cols: int,
+                    epoch, date_styles, td_styles):
+    # 1行ずつ [(行, 列, 共有文字列番号, 値), ...] を列順で返す。max_rows を超えた行で伸長を止める
+    next_row = 1
+    row_no = col_no = 0
+    row_cells: Dict[int, tuple] | None = None
+    sheet_data = None
+    with zf.open(path) as src:
+        for event, el in _xml_iter(src, events=("start", "end")):
+            tag = el.tag
+            if event == "start":
+                if tag == _TAG_ROW:
+                    r = el.get("r")
+                    if r is not None:
+                        try:
+                            row_no = int(r)
+                        except ValueError:
+                            f = float(r)
+                            if not f.is_integer():
+                                raise _XlsxFallback(f"invalid row number {r}")
+                            row_no = int(f)
+                    else:
+                        row_no += 1
+                    col_no = 0
+                    if row_no > max_rows:
+                        return
+                    row_cells = {} if row_no >= next_row else None
+                elif tag == _TAG_SHEETDATA:
+                    sheet_data = el
                 continue
-            txt = to_str(v)
-            if not txt:
+
+            if tag == _TAG_C:
+                coord = el.get("r")
+                if coord:
+                    m = _COORD_RE.match(coord)
+                    if not m:
+                        raise _XlsxFallback(f"invalid coordinate {coord}")
+                    cell_row, col_no = int(m.group(2)), _col_to_num(m.group(1))
+                else:
+                    col_no += 1
+                    cell_row = row_no
+                if row_cells is not None and col_no <= max_cols:
+                    sst_idx, value = _xlsx_cell_value(el, epoch, date_styles, td_styles)
+                    if sst_idx is not None or value is not None:
+                        row_cells[col_no] = (cell_row, col_no, sst_idx, value)
+                    else:
+                        row_cells.pop(col_no, None)
+            elif tag == _TAG_ROW:
+                if row_cells is not None:
+                    next_row = row_no + 1
+                    if row_cells:
+                        yield [row_cells[c] for c in sorted(row_cells)]
+                    row_cells = None
+                if sheet_data is not None:
+                    sheet_data.clear()
+
+def _xlsx_shared_strings(zf: zipfile.ZipFile, path: str | None, wanted: set) -> Dict[int, str]:
+    # 必要な番号だけ取り出し、最大番号を過ぎたら伸長を打ち切る
+    found: Dict[int, str] = {}
+    if not wanted:
+        return found
+    if path is None:
+        raise _XlsxFallback("shared string table missing")
+    last = max(wanted)
+    idx = 0
+    with zf.open(path) as src:
+        for _, el in _xml_iter(src):
+            if el.tag != _TAG_SI:
                 continue
-            lines.append(f"{cell.coordinate}\t{txt}")
-            count += 1
-            if count >= max_nonempty:
-                lines.append("# ...truncated...")
+            if idx in wanted:
+                found[idx] = _rich_text_content(el).replace("x005F_", "")
+            el.clear()
+            if idx >= last:
                 break
-        if count >= max_nonempty:
+            idx += 1
+    if len(found) != len(wanted):
+        raise _XlsxFallback("shared string index out of range")
+    return found
+
+def _emit_row(cells, count: int, limit: int, fmt: str, typed: bool = False):
+    # cells: 1行ぶんの [(行, 列, 値), ...]。非空セルを 'A1<TAB>値' にし、通算 limit 件で打ち切る。
+    # typed のときは座標を文字列にせず (行, 列, 値, 型) のまま返す
+    t0 = time.perf_counter()
+    lines = []
+    letters = _col_letter_table(cells[-1][1]) if cells else _COL_LETTERS  # cells は列順
+    for (r, c, v), txt in zip(cells, _normalize_row([v for _, _, v in cells])):
+        if not txt:
+            continue
+        lines.append((r, c, txt, _CELL_TYPES.get(type(v), "s")) if typed else f"{letters[c - 1]}{r}\t{txt}")
+        count += 1
+        if count >= limit:
             break
-    return "\n".join(lines)
+    _stage_add(fmt, "normalize", time.perf_counter() - t0)
+    return lines, count
+
+def _emit_dense_row(r: int, values, count: int, limit: int, fmt: str, typed: bool = False):
+    # values: 1列目から並んだ1行ぶんの値（空セルは empty のまま）。_emit_row と同じ出力を、
+    # (行, 列, 値) を組み立てずに行全体の一括正規化と列記号の表引きで作る
+    t0 = time.perf_counter()
+    texts = _normalize_row(values)
+    if typed:
+        get = _CELL_TYPES.get
+        lines = [(r, c, txt, get(type(v), "s")) for c, txt, v in zip(itertools.count(1), texts, values) if txt]
+    else:
+        row = str(r)
+        lines = [f"{col}{row}\t{txt}" for col, txt in zip(_col_letter_table(len(texts)), texts) if txt]
+    if len(lines) > limit - count:
+        del lines[limit - count:]
+    _stage_add(fmt, "normalize", time.perf_counter() - t0)
+    return lines, count + len(lines)
+
+_DENSE_SAMPLE_ROWS = 32  # 密度を見る先頭の行数
+
+def _nonempty_flags(values, empty) -> bytes:
+    # 非空セルの位置が 1 のバイト列。判定は C の関数で回し（openpyxl の None は is_not、xlrd の "" は ne）、
+    # 非空セルは bytes.find で飛び移るので、幅の広い行でも Python のループは非空セルの数しか回らない
+    return bytes(map(operator.is_not if empty is None else operator.ne, values, itertools.repeat(empty)))
+
+def _dense_width(sample: List, empty) -> int:
+    # 先頭の数行で使われている列幅と、その中の非空セルの割合を見る。密なら列幅、疎なら 0
+    width = nonempty = 0
+    for values in sample:
+        nonempty += len(values) - values.count(empty)
+        width = max(width, _nonempty_flags(values, empty).rfind(1) + 1)
+    return width if nonempty and nonempty >= width * len(sample) * DENSE_SHEET_THRESHOLD else 0
+
+def _emit_values_row(r: int, values, width: int, empty, count: int, limit: int, fmt: str, typed: bool = False):
+    # values は1列目からの1行ぶん。先頭 width 列は一括で変換し、それより右（標本より右に出てきたセル）は疎な経路で拾う
+    lines = []
+    if width:
+        lines, count = _emit_dense_row(r, values[:width], count, limit, fmt, typed)
+        values = values[width:]
+    if count < limit and values.count(empty) != len(values):
+        flags = _nonempty_flags(values, empty)
+        cells = []
+        i = flags.find(1)
+        while i >= 0:
+            cells.append((r, width + 1 + i, values[i]))
+            i = flags.find(1, i + 1)
+        more, count = _emit_row(cells, count, limit, fmt, typed)
+        lines += more
+    return lines, count
+
+def _with_truncation(rows, limit: int):
+    # rows は合計 limit 行で止まる。上限に達したら最後の行に truncated を付ける
+    count = 0
+    for lines in rows:
+        count += len(lines)
+        if count >= limit:
+            yield lines + ["# ...truncated..."]
+            return
+        yield lines
+
+def _pick_sheets(names: List[str], sheets_req: str) -> List[int]:
+    # "all" / カンマ区切り（各要素は名前 / 0始まり / 1始まり）
+    if sheets_req in names:
+        return [names.index(sheets_req)]
+    if sheets_req.strip().lower() == "all":
+        return list(range(len(names)))
+    picked = []
+    for tok in sheets_req.split(","):
+        tok = tok.strip()
+        if not tok:
+            continue
+        idx = _pick_sheet_index(names, tok)
+        if idx is None:
+            raise ValueError(f"sheet not found: {tok}")
+        if idx not in picked:
+            picked.append(idx)
+    return picked
+
+def _iter_multi_sheet_rows(sheets, max_nonempty: int, max_per_sheet: int):
+    # sheets: [(シート名, limit を受けて行を返す関数), ...]。シートごとに見出し行を付ける
+    total = 0
+    for name, sheet_rows in sheets:
+        yield [f"# sheet: {name}"]
+        limit = min(max_per_sheet, max_nonempty - total)
+        count = 0
+        for lines in sheet_rows(limit):
+            count += len(lines)
+            total += len(lines)
+            if count >= limit:
+                lines = lines + ["# ...truncated..."]
+            yield lines
+        if total >= max_nonempty:
+            return
+
+def _iter_with_fallback(primary, secondary):
+    # primary が扱えない構造だった場合は secondary で読み直す。送信済みの行は出力が同一なので読み飛ばす
+    sent = 0
+    try:
+        for lines in primary():
+            sent += len(lines)
+            yield lines
+        return
+    except (_XlsxFallback, zipfile.BadZipFile, KeyError, ValueError, ET.ParseError):
+        pass  # 壊れた/特殊なブックは openpyxl に任せる（エラー文言も従来どおり）
+    for lines in secondary():
+        if sent >= len(lines):
+            sent -= len(lines)
+            continue
+        yield lines[sent:]
+        sent = 0
+
+def _xlsx_stream_context(zf: zipfile.ZipFile) -> Dict:
+    info = _xlsx_workbook_info(zf)
+    info["date_styles"], info["td_styles"] = _xlsx_date_styles(zf)
+    info["sst"] = {}  # 解決済みの共有文字列（シート間で共有）
+    return info
+
+def _xlsx_stream_sheet_rows(zf: zipfile.ZipFile, ctx: Dict, sheet: Dict,
+                            max_rows: int, max_cols: int, limit: int, typed: bool = False):
+    # 1行ぶんのTSV行リストを順に返す。非空セルが limit 件に達したところで止める
+    if limit <= 0:
+        return
+    rows = _xlsx_iter_rows(zf, sheet["path"], max_rows, max_cols,
+                           ctx["epoch"], ctx["date_styles"], ctx["td_styles"])
+    sst = ctx["sst"]
+    count = 0
+    exhausted = False
+    try:
+        while True:
+            # 残り枠ぶんの候補セルを先読みし、その分の共有文字列だけをまとめて解決
+            pending, ncells = [], 0
+            while not exhausted and ncells < limit - count:
+                row = next(rows, None)
+                if row is None:
+                    exhausted = True
+                else:
+                    pending.append(row)
+                    ncells += len(row)
+            missing = {i for row in pending for _, _, i, _ in row if i is not None and i not in sst}
+            sst.update(_xlsx_shared_strings(zf, ctx["sst_path"], missing))
+
+            for row in pending:
+                lines, count = _emit_row([(r, c, sst[i] if i is not None else v) for r, c, i, v in row],
+                                         count, limit, "xlsx", typed)
+                if lines:
+                    yield lines
+                if count >= limit:
+                    return
+            if exhausted:
+                break
+    finally:
+        rows.close()
+
+def _iter_xlsx_stream_rows(xlsx_bytes: bytes,
+                           sheet_req: str | None = None,
+                           max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY, typed: bool = False):
+    with zipfile.ZipFile(BytesIO(xlsx_bytes)) as zf:
+        with _stage("xlsx", "open"):
+            ctx = _xlsx_stream_context(zf)
+        sheets = ctx["sheets"]
+        idx = _pick_sheet_index([s["name"] for s in sheets], sheet_req)
+        if idx is None:
+            idx = ctx["active"]
+        try:
+            sheet = sheets[idx]
+        except IndexError:
+            raise _XlsxFallback("active sheet not found")
+        if sheet["chart"]:
+            raise _XlsxFallback("chartsheet selected")
+        yield from _with_truncation(
+            _xlsx_stream_sheet_rows(zf, ctx, sheet, max_rows, max_cols, max_nonempty, typed), max_nonempty)
+
+def _iter_xlsx_stream_multi_rows(xlsx_bytes: bytes, sheets_req: str,
+                                 max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY,
+                                 max_per_sheet=MAX_NONEMPTY_PER_SHEET, typed: bool = False):
+    with zipfile.ZipFile(BytesIO(xlsx_bytes)) as zf:
+        with _stage("xlsx", "open"):
+            ctx = _xlsx_stream_context(zf)
+        sheets = ctx["sheets"]
+        picked = [sheets[i] for i in _pick_sheets([s["name"] for s in sheets], sheets_req)]
+        yield from _iter_multi_sheet_rows(
+            [(s["name"], lambda limit, s=s: _xlsx_stream_sheet_rows(zf, ctx, s, max_rows, max_cols, limit, typed))
+             for s in picked if not s["chart"]],
+            max_nonempty, max_per_sheet)
+
+def _openpyxl_sheet_rows(ws, max_rows: int, max_cols: int, limit: int, typed: bool = False):
+    # values_only で行ごとの値のタプルを受け取る（read_only では欠けた行も埋めて返るので行番号は通し番号）
+    if limit <= 0:
+        return
+    count = 0
+    rows = ws.iter_rows(min_row=1, max_row=max_rows, min_col=1, max_col=max_cols, values_only=True)
+    sample = list(itertools.islice(rows, _DENSE_SAMPLE_ROWS))
+    width = _dense_width(sample, None)
+    for r, values in enumerate(itertools.chain(sample, rows), 1):
+        lines, count = _emit_values_row(r, values, width, None, count, limit, "xlsx", typed)
+        if lines:
+            yield lines
+        if count >= limit:
+            return
+
+def _iter_xlsx_openpyxl_rows(xlsx_bytes: bytes,
+                             sheet_req: str | None = None,
+                             max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY, typed: bool = False):
+    with _stage("xlsx", "open"):
+        from openpyxl import load_workbook
+        wb = load_workbook(BytesIO(xlsx_bytes), data_only=True, read_only=True)
+    ws = None
+    idx = _pick_sheet_index(wb.sheetnames, sheet_req)
+    if idx is not None:
+        ws = wb[wb.sheetnames[idx]]
+    ws = ws or wb.active
+    yield from _with_truncation(_openpyxl_sheet_rows(ws, max_rows, max_cols, max_nonempty, typed), max_nonempty)
+
+def _iter_xlsx_openpyxl_multi_rows(xlsx_bytes: bytes, sheets_req: str,
+                                   max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY,
+                                   max_per_sheet=MAX_NONEMPTY_PER_SHEET, typed: bool = False):
+    with _stage("xlsx", "open"):
+        from openpyxl import load_workbook
+        wb = load_workbook(BytesIO(xlsx_bytes), data_only=True, read_only=True)
+    names = wb.sheetnames
+    picked = [wb[names[i]] for i in _pick_sheets(names, sheets_req)]
+    yield from _iter_multi_sheet_rows(
+        [(ws.title, lambda limit, ws=ws: _openpyxl_sheet_rows(ws, max_rows, max_cols, limit, typed))
+         for ws in picked if hasattr(ws, "iter_rows")],  # グラフシートは飛ばす
+        max_nonempty, max_per_sheet)
+
+def _iter_xlsx_rows(xlsx_bytes: bytes,
+                    sheet_req: str | None = None,
+                    max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY, typed: bool = False):
+    args = (xlsx_bytes, sheet_req, max_rows, max_cols, max_nonempty, typed)
+    if not XLSX_STREAMING:
+        return _iter_xlsx_openpyxl_rows(*args)
+    return _iter_with_fallback(lambda: _iter_xlsx_stream_rows(*args), lambda: _iter_xlsx_openpyxl_rows(*args))
+
+def _iter_xlsx_multi_rows(xlsx_bytes: bytes, sheets_req: str,
+                          max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY,
+                          max_per_sheet=MAX_NONEMPTY_PER_SHEET, typed: bool = False):
+    args = (xlsx_bytes, sheets_req, max_rows, max_cols, max_nonempty, max_per_sheet, typed)
+    if not XLSX_STREAMING:
+        return _iter_xlsx_openpyxl_multi_rows(*args)
+    return _iter_with_fallback(lambda: _iter_xlsx_stream_multi_rows(*args),
+                               lambda: _iter_xlsx_openpyxl_multi_rows(*args))
+
+def _excel_sparse_from_xlsx_stream(xlsx_bytes: bytes,
+                                   sheet_req: str | None = None,
+                                   max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY) -> str:
+    return _join_rows(_iter_xlsx_stream_rows(xlsx_bytes, sheet_req, max_rows, max_cols, max_nonempty))
+
+def _excel_sparse_from_xlsx_openpyxl(xlsx_bytes: bytes,
+                                     sheet_req: str | None = None,
+                                     max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY) -> str:
+    return _join_rows(_iter_xlsx_openpyxl_rows(xlsx_bytes, sheet_req, max_rows, max_cols, max_nonempty))
 
-def _excel_sparse_from_xls_bytes(xls_bytes: bytes,
-                                 max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY) -> str:
-    with tempfile.NamedTemporaryFile(delete=True, suffix=".xls") as tmp:
-        tmp.write(xls_bytes)
+def _excel_sparse_from_xlsx_bytes(xlsx_bytes: bytes,
+                                  sheet_req: str | None = None,
+                                  max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY) -> str:
+    return _join_rows(_iter_xlsx_rows(xlsx_bytes, sheet_req, max_rows, max_cols, max_nonempty))
+
+@contextmanager
+def _spooled(data: bytes):
+    # 閾値以下はそのまま bytes を渡す。超える場合のみディスクに書き、mmap で読ませる
+    if len(data) <= SPOOL_THRESHOLD:
+        yield data
+        return
+    with tempfile.TemporaryFile() as tmp:
+        tmp.write(data)
         tmp.flush()
-        book = xlrd.open_workbook(tmp.name)
+        with mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+def _xls_sheet_rows(sheet, max_rows: int, max_cols: int, limit: int, typed: bool = False):
+    # 行は row_values でまとめて取り出す（空セルは ""）
+    if limit <= 0:
+        return
+    count = 0
+    max_r = min(sheet.nrows, max_rows)
+    max_c = min(sheet.ncols, max_cols)
+    width = _dense_width([sheet.row_values(r, 0, max_c) for r in range(min(max_r, _DENSE_SAMPLE_ROWS))], "")
+    for r in range(max_r):
+        lines, count = _emit_values_row(r + 1, sheet.row_values(r, 0, max_c), width, "", count, limit, "xls", typed)
+        if lines:
+            yield lines
+        if count >= limit:
+            return
+
+def _iter_xls_rows(xls_bytes: bytes,
+                   max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY, typed: bool = False):
+    with _spooled(xls_bytes) as src:
+        with _stage("xls", "open"):
+            import xlrd
+            book = xlrd.open_workbook(file_contents=src)
         sheet = book.sheet_by_index(0)  # 先頭シートのみ
+        yield from _with_truncation(_xls_sheet_rows(sheet, max_rows, max_cols, max_nonempty, typed), max_nonempty)
+
+def _iter_xls_multi_rows(xls_bytes: bytes, sheets_req: str,
+                         max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY,
+                         max_per_sheet=MAX_NONEMPTY_PER_SHEET, typed: bool = False):
+    with _spooled(xls_bytes) as src:
+        with _stage("xls", "open"):
+            import xlrd
+            book = xlrd.open_workbook(file_contents=src, on_demand=True)
+        names = book.sheet_names()
+        picked = _pick_sheets(names, sheets_req)
+        yield from _iter_multi_sheet_rows(
+            [(names[i], lambda limit, i=i: _xls_sheet_rows(book.sheet_by_index(i), max_rows, max_cols, limit, typed))
+             for i in picked],
+            max_nonempty, max_per_sheet)
 
-        lines, count = [], 0
-        max_r = min(sheet.nrows, max_rows)
-        max_c = min(sheet.ncols, max_cols)
-        for r in range(max_r):
-            for c in range(max_c):
-                v = sheet.cell_value(r, c)
-                txt = to_str(v)
-                if not txt:
-                    continue
-                coord = f"{_num_to_col(c+1)}{r+1}"
-                lines.append(f"{coord}\t{txt}")
-                count += 1
-                if count >= max_nonempty:
-                    lines.append("# ...truncated...")
-                    break
-            if count >= max_nonempty:
-                break
-    return "\n".join(lines)
+def _excel_sparse_from_xls_bytes(xls_bytes: bytes,
+                                 max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY) -> str:
+    return _join_rows(_iter_xls_rows(xls_bytes, max_rows, max_cols, max_nonempty))
+
+def _join_rows(rows) -> str:
+    return "\n".join(line for lines in rows for line in lines)
+
+def _excel_format(filename: str | None, data: bytes | None = None) -> str:
+    # 中身で決まればそれを優先し、決まらないときだけ拡張子を見る
+    kind = _sniff_format(data) if data else None
+    if kind == "zip":
+        return "xlsx"
+    if kind == "xls":
+        return "xls"
+    return "xls" if (filename or "").lower().endswith(".xls") else "xlsx"
+
+def _excel_sparse_key(data: bytes,
+                      filename: str | None = None,
+                      sheet_req: str | None = None,
+                      max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY,
+                      sheets_req: str | None = None, max_per_sheet=MAX_NONEMPTY_PER_SHEET,
+                      typed: bool = False) -> str:
+    fmt = _excel_format(filename, data)
+    is_xls = fmt == "xls"
+    kind = fmt + ("+cells" if typed else "")  # 構造化出力は TSV とは別の値としてキャッシュする
+    if sheets_req:
+        return _extract_cache_key(data, kind + "+sheets", f"{sheets_req}\0{max_per_sheet}",
+                                  max_rows, max_cols, max_nonempty)
+    # .xls は先頭シート固定なのでシート指定はキーに含めない
+    return _extract_cache_key(data, kind, None if is_xls else sheet_req,
+                              max_rows, max_cols, max_nonempty)
+
+def _iter_excel_rows(data: bytes,
+                     filename: str | None = None,
+                     sheet_req: str | None = None,
+                     max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY,
+                     sheets_req: str | None = None, max_per_sheet=MAX_NONEMPTY_PER_SHEET,
+                     typed: bool = False):
+    fmt = _excel_format(filename, data)
+    if fmt == "xlsx":
+        _check_xlsx_budget(data)  # 展開前に zip 爆弾を弾く
+    if sheets_req:
+        if fmt == "xls":
+            rows = _iter_xls_multi_rows(data, sheets_req, max_rows, max_cols, max_nonempty, max_per_sheet, typed)
+        else:
+            rows = _iter_xlsx_multi_rows(data, sheets_req, max_rows, max_cols, max_nonempty, max_per_sheet, typed)
+    elif fmt == "xls":
+        rows = _iter_xls_rows(data, max_rows, max_cols, max_nonempty, typed)
+    else:
+        rows = _iter_xlsx_rows(data, sheet_req, max_rows, max_cols, max_nonempty, typed)
+    return _timed_rows(fmt, rows)
+
+def _excel_sparse_uncached(data: bytes,
+                           filename: str | None = None,
+                           sheet_req: str | None = None,
+                           max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY,
+                           sheets_req: str | None = None, max_per_sheet=MAX_NONEMPTY_PER_SHEET) -> str:
+    return _join_rows(_iter_excel_rows(data, filename, sheet_req, max_rows, max_cols, max_nonempty,
+                                       sheets_req, max_per_sheet))
 
 def _excel_sparse_from_bytes(data: bytes,
                              filename: str | None = None,
                              sheet_req: str | None = None,
-                             max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY) -> str:
-    name = (filename or "").lower()
-    if name.endswith(".xls"):
-        return _excel_sparse_from_xls_bytes(data, max_rows, max_cols, max_nonempty)
-    return _excel_sparse_from_xlsx_bytes(data, sheet_req, max_rows, max_cols, max_nonempty)
+                             max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY,
+                             sheets_req: str | None = None, max_per_sheet=MAX_NONEMPTY_PER_SHEET) -> str:
+    key = _excel_sparse_key(data, filename, sheet_req, max_rows, max_cols, max_nonempty,
+                            sheets_req, max_per_sheet)
+    result = _extract_cache.get(key)
+    if result is None:
+        result = _run_parse(_excel_sparse_uncached, data, filename, sheet_req, max_rows, max_cols, max_nonempty,
+                            sheets_req, max_per_sheet)
+        _extract_cache.put(key, result)
+    _observe_cells(_excel_format(filename, data), result.split("\n"))
+    return result
+
+def _columnar(rows) -> Dict:
+    # typed の行 → シートごとに行・列・値・型を並列の配列で持つ。sheets 指定が無いときは名前なしの1シート
+    sheets: List[Dict] = []
+    cur = None
+    for lines in rows:
+        for item in lines:
+            if type(item) is tuple:
+                if cur is None:
+                    cur = {"name": None, "row": [], "col": [], "value": [], "type": [], "truncated": False}
+                    sheets.append(cur)
+                r, c, txt, t = item
+                cur["row"].append(r)
+                cur["col"].append(c)
+                cur["value"].append(txt)
+                cur["type"].append(t)
+            elif item.startswith("# sheet: "):
+                cur = {"name": item[len("# sheet: "):], "row": [], "col": [], "value": [], "type": [],
+                       "truncated": False}
+                sheets.append(cur)
+            elif item == "# ...truncated..." and cur is not None:
+                cur["truncated"] = True
+    if not sheets:
+        sheets.append({"name": None, "row": [], "col": [], "value": [], "type": [], "truncated": False})
+    return {"sheets": sheets}
+
+def _excel_cells_uncached(data: bytes,
+                          filename: str | None = None,
+                          sheet_req: str | None = None,
+                          max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY,
+                          sheets_req: str | None = None, max_per_sheet=MAX_NONEMPTY_PER_SHEET) -> str:
+    # キャッシュにもプール間の受け渡しにも使うので、詰めた JSON 文字列で返す
+    doc = _columnar(_iter_excel_rows(data, filename, sheet_req, max_rows, max_cols, max_nonempty,
+                                     sheets_req, max_per_sheet, typed=True))
+    return json.dumps(doc, ensure_ascii=False, separators=(",", ":"))
+
+def _excel_cells_from_bytes(data: bytes,
+                            filename: str | None = None,
+                            sheet_req: str | None = None,
+                            max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY,
+                            sheets_req: str | None = None, max_per_sheet=MAX_NONEMPTY_PER_SHEET) -> Dict:
+    key = _excel_sparse_key(data, filename, sheet_req, max_rows, max_cols, max_nonempty,
+                            sheets_req, max_per_sheet, typed=True)
+    result = _extract_cache.get(key)
+    if result is None:
+        result = _run_parse(_excel_cells_uncached, data, filename, sheet_req, max_rows, max_cols, max_nonempty,
+                            sheets_req, max_per_sheet)
+        _extract_cache.put(key, result)
+    doc = json.loads(result)
+    _observe_doc(_excel_format(filename, data), doc)
+    return doc
+
+def _iter_excel_sparse_cached(data: bytes,
+                              filename: str | None = None,
+                              sheet_req: str | None = None,
+                              max_rows=MAX_ROWS, max_cols=MAX_COLS, max_nonempty=MAX_NONEMPTY,
+                              sheets_req: str | None = None, max_per_sheet=MAX_NONEMPTY_PER_SHEET):
+    # ストリーミング応答用：キャッシュにあれば一括、無ければ行ごとに返しつつ最後にキャッシュへ。
+    # プール使用時は行の読み出しをワーカーで行い（時間・メモリの上限はそこで掛かる）、できた行から受け取る
+    key = _excel_sparse_key(data, filename, sheet_req, max_rows, max_cols, max_nonempty,
+                            sheets_req, max_per_sheet)
+    cached = _extract_cache.get(key)
+    if cached is not None:
+        lines = cached.split("\n") if cached else []
+        _observe_cells(_excel_format(filename, data), lines)
+        if lines:
+            yield lines
+        return
+    produced = []
+    args = (data, filename, sheet_req, max_rows, max_cols, max_nonempty, sheets_req, max_per_sheet)
+    rows = _iter_pooled(_iter_excel_rows, *args) if _parse_pool_workers() > 0 else _iter_excel_rows(*args)
+    for lines in rows:
+        produced.extend(lines)
+        yield lines
+    _observe_cells(_excel_format(filename, data), produced)
+    _extract_cache.put(key, "\n".join(produced))
 
 def _is_excel_filename(name: str) -> bool:
     n = (name or "").lower()
@@ -406,18 +1359,792 @@ def _is_excel_mime(mime: str) -> bool:
         or m == "application/vnd.ms-excel"
     )
 
+# ========= 抽出結果キャッシュ =========
+# 同じブックが /extract への再アップロードや転送メールの添付で何度も届くため、
+# 内容ハッシュで結果を引く。メモリ層はバイト数上限付きLRU、ディスク層は任意。
+
+_OUTPUT_VERSION = 2  # 抽出結果の書式を変えたら上げる（ディスク層に残った古い結果を使わないため）
+# ディスク層の合計サイズは書き込むたびに数えず、前回走査した合計に自分の書き込み分を足した見積もりで判断する。
+# 見積もりが上限を超えたとき（他ワーカーの書き込みを拾うため _DISK_RESCAN 秒ごとにも）だけ走査し、
+# 消すときは上限の _DISK_PRUNE_TO まで減らして、上限付近で毎回走査し直さないようにする。
+_DISK_RESCAN = 60.0
+_DISK_PRUNE_TO = 0.9
+
+def _extract_cache_key(data: bytes, fmt: str, sheet_req: str | None,
+                       max_rows: int, max_cols: int, max_nonempty: int) -> str:
+    h = hashlib.sha256(data)
+    h.update(f"\0v{_OUTPUT_VERSION}\0{fmt}\0{sheet_req or ''}\0{max_rows}\0{max_cols}\0{max_nonempty}".encode("utf-8"))
+    return h.hexdigest()
+
+class _ExtractCache:
+    def __init__(self, max_bytes: int, disk_dir: str = "", disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._items: "OrderedDict[str, str]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+        self.disk_hits = self.disk_writes = self.disk_evictions = 0
+        self._disk_bytes = 0        # ディスク層の合計サイズの見積もり
+        self._disk_scanned = None   # 最後に走査した時刻（未走査は None）
+        self._disk_pruning = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 or bool(self.disk_dir)
+
+    def get(self, key: str) -> str | None:
+        if not self.enabled:
+            return None
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return value
+        value = self._disk_get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+        self._mem_put(key, value)
+        return value
+
+    def put(self, key: str, value: str) -> None:
+        if not self.enabled:
+            return
+        self._mem_put(key, value)
+        self._disk_put(key, value)
+
+    def _mem_put(self, key: str, value: str) -> None:
+        size = sys.getsizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= sys.getsizeof(old)
+            self._items[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= sys.getsizeof(evicted)
+                self.evictions += 1
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key + ".tsv")
+
+    def _disk_get(self, key: str) -> str | None:
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key), "r", encoding="utf-8", newline="") as fh:
+                return fh.read()
+        except OSError:
+            return None
+
+    def _disk_put(self, key: str, value: str) -> None:
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            try:
+                replaced = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 他ワーカーが読みかけのファイルを見ないよう、一時ファイルから rename で置き換える
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8", newline="") as fh:
+                fh.write(value)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        with self._lock:
+            self.disk_writes += 1
+            self._disk_bytes += size - replaced
+            due = not self._disk_pruning and (
+                self._disk_bytes > self.disk_max_bytes or self._disk_scanned is None
+                or time.monotonic() - self._disk_scanned >= _DISK_RESCAN)
+            if due:
+                self._disk_pruning = True
+        if due:
+            try:
+                self._disk_prune()
+            finally:
+                with self._lock:
+                    self._disk_pruning = False
+
+    def _disk_prune(self) -> None:
+        # 合計を数え直し、上限超過時は更新の古い順に消す
+        entries, total = [], 0
+        for root, _, files in os.walk(self.disk_dir):
+            for fn in files:
+                if not fn.endswith(".tsv"):
+                    continue
+                p = os.path.join(root, fn)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+                total += st.st_size
+        if total > self.disk_max_bytes:
+            target = int(self.disk_max_bytes * _DISK_PRUNE_TO)
+            entries.sort()
+            for _, size, p in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(p)
+                except OSError:
+                    continue
+                total -= size
+                with self._lock:
+                    self.disk_evictions += 1
+        with self._lock:
+            self._disk_bytes = total
+            self._disk_scanned = time.monotonic()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "disk_dir": self.disk_dir or None,
+                "disk_hits": self.disk_hits,
+                "disk_writes": self.disk_writes,
+                "disk_evictions": self.disk_evictions,
+            }
+
+_extract_cache = _ExtractCache(EXTRACT_CACHE_BYTES, EXTRACT_CACHE_DIR, EXTRACT_CACHE_DISK_BYTES)
+
+# ========= ブックのセッション（/workbooks） =========
+# 1回のアップロードで全シートの非空セルを索引にし、以後の範囲指定の問い合わせはそこから返す。
+# 索引は行番号の昇順に並べ、行ごとに列番号の昇順で 'A1<TAB>値' を持つので、範囲は二分探索で切り出せる。
+# 最後の参照から SESSION_TTL 秒で失効し、合計が SESSION_MAX_BYTES を超えたら参照の古い順に捨てる。
+# セッションはプロセス単位（gunicorn で複数ワーカーを立てる場合は同じワーカーに届く必要がある）。
+
+_SESSION_MAX_ROWS = 1048576  # xlsx の行数上限
+_SESSION_MAX_COLS = 16384    # xlsx の列数上限（XFD）
+_RANGE_PART_RE = re.compile(r"^\$?([A-Za-z]{0,3})\$?(\d*)$")
+
+class _SheetIndex:
+    __slots__ = ("name", "rows", "starts", "cols", "lines", "truncated")
+
+    def __init__(self, name: str, cells: List[tuple], truncated: bool):
+        # cells: [(行, 列, 'A1<TAB>値'), ...]
+        cells.sort(key=lambda x: (x[0], x[1]))
+        self.name = name
+        self.rows = array("I")    # 非空セルのある行番号
+        self.starts = array("I")  # rows[i] のセルが cols / lines の何番目から始まるか（末尾は総数）
+        self.cols = array("H")
+        self.lines: List[str] = []
+        self.truncated = truncated
+        for r, c, line in cells:
+            if not self.rows or self.rows[-1] != r:
+                self.rows.append(r)
+                self.starts.append(len(self.lines))
+            self.cols.append(c)
+            self.lines.append(line)
+        self.starts.append(len(self.lines))
+
+    def query(self, r1: int, c1: int, r2: int, c2: int) -> List[str]:
+        out: List[str] = []
+        rows, starts, cols, lines = self.rows, self.starts, self.cols, self.lines
+        for i in range(bisect.bisect_left(rows, r1), bisect.bisect_right(rows, r2)):
+            lo, hi = starts[i], starts[i + 1]
+            out += lines[bisect.bisect_left(cols, c1, lo, hi):bisect.bisect_right(cols, c2, lo, hi)]
+        return out
+
+    def info(self) -> Dict:
+        dim = None
+        if self.lines:
+            dim = (f"{_num_to_col(min(self.cols))}{self.rows[0]}:"
+                   f"{_num_to_col(max(self.cols))}{self.rows[-1]}")
+        return {"name": self.name, "cells": len(self.lines), "range": dim, "truncated": self.truncated}
+
+    def nbytes(self) -> int:
+        return (sum(sys.getsizeof(s) for s in self.lines) + sys.getsizeof(self.lines)
+                + sum(a.itemsize * len(a) for a in (self.rows, self.starts, self.cols)))
+
+def _default_sheet_name(data: bytes, filename: str | None = None) -> str | None:
+    # シート指定なしの /extract が読むシート（xlsx はアクティブシート、.xls は先頭シート = None）
+    if _excel_format(filename, data) == "xls":
+        return None
+    if XLSX_STREAMING:
+        try:
+            with zipfile.ZipFile(BytesIO(data)) as zf:
+                info = _xlsx_workbook_info(zf)
+            return info["sheets"][info["active"]]["name"]
+        except (_XlsxFallback, zipfile.BadZipFile, KeyError, ValueError, IndexError, ET.ParseError):
+            pass
+    from openpyxl import load_workbook
+    ws = load_workbook(BytesIO(data), read_only=True).active
+    return ws.title if ws is not None else None
+
+def _build_workbook_index(data: bytes, filename: str | None = None) -> tuple:
+    # 抽出と同じ経路（ストリーミング / openpyxl / xlrd）で全シートを読み、出力行から索引を組み立てる。
+    # (シートの索引, シート指定なしで返すシートの位置) を返す
+    sheets = []
+    name, cells, truncated = None, [], False
+    for lines in _iter_excel_rows(data, filename, None, _SESSION_MAX_ROWS, _SESSION_MAX_COLS, SESSION_MAX_CELLS,
+                                  "all", SESSION_MAX_CELLS):
+        for line in lines:
+            if line.startswith("# sheet: "):
+                if name is not None:
+                    sheets.append(_SheetIndex(name, cells, truncated))
+                name, cells, truncated = line[len("# sheet: "):], [], False
+            elif line == "# ...truncated...":
+                truncated = True
+            else:
+                m = _COORD_RE.match(line.partition("\t")[0])
+                cells.append((int(m.group(2)), _col_to_num(m.group(1)), line))
+    if name is not None:
+        sheets.append(_SheetIndex(name, cells, truncated))
+    default = _default_sheet_name(data, filename)
+    return sheets, next((i for i, s in enumerate(sheets) if s.name == default), 0)
+
+def _parse_range(range_req: str | None) -> tuple:
+    # "B15:AW80" / "B15" / "B:AW"（列全体）/ "15:80"（行全体）→ (行1, 列1, 行2, 列2)
+    if not range_req:
+        return 1, 1, _SESSION_MAX_ROWS, _SESSION_MAX_COLS
+    parts = range_req.strip().split(":")
+    if len(parts) > 2:
+        raise ValueError(f"invalid range: {range_req}")
+    if len(parts) == 1:
+        parts = parts * 2
+    bounds = []
+    for part, (row_default, col_default) in zip(parts, ((1, 1), (_SESSION_MAX_ROWS, _SESSION_MAX_COLS))):
+        m = _RANGE_PART_RE.match(part.strip())
+        if not m or not (m.group(1) or m.group(2)):
+            raise ValueError(f"invalid range: {range_req}")
+        bounds.append((int(m.group(2)) if m.group(2) else row_default,
+                       _col_to_num(m.group(1)) if m.group(1) else col_default))
+    (r1, c1), (r2, c2) = bounds
+    return min(r1, r2), min(c1, c2), max(r1, r2), max(c1, c2)
+
+class _WorkbookSessions:
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._items: "OrderedDict[str, Dict]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.created = self.expired = self.evictions = 0
+
+    def _expire(self, now: float) -> None:
+        # 参照順に並んでいるので、先頭から期限切れを捨てる
+        while self._items:
+            sid, wb = next(iter(self._items.items()))
+            if wb["expires"] > now:
+                break
+            self._drop(sid)
+            self.expired += 1
+
+    def _drop(self, sid: str) -> None:
+        wb = self._items.pop(sid)
+        self._bytes -= wb["bytes"]
+
+    def put(self, filename: str, fmt: str, sheets: List[_SheetIndex], active: int = 0) -> Dict | None:
+        size = sum(s.nbytes() for s in sheets)
+        if size > self.max_bytes:
+            return None
+        now = time.monotonic()
+        wb = {"id": secrets.token_urlsafe(16), "filename": filename, "format": fmt, "sheets": sheets,
+              "active": active, "bytes": size, "expires": now + self.ttl}
+        with self._lock:
+            self._expire(now)
+            self._items[wb["id"]] = wb
+            self._bytes += size
+            self.created += 1
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._items)))
+                self.evictions += 1
+        return wb
+
+    def get(self, sid: str) -> Dict | None:
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            wb = self._items.get(sid)
+            if wb is not None:
+                wb["expires"] = now + self.ttl
+                self._items.move_to_end(sid)
+            return wb
+
+    def delete(self, sid: str) -> bool:
+        with self._lock:
+            if sid not in self._items:
+                return False
+            self._drop(sid)
+            return True
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._expire(time.monotonic())
+            return {
+                "sessions": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "created": self.created,
+                "expired": self.expired,
+                "evictions": self.evictions,
+            }
+
+def _session_info(wb: Dict) -> Dict:
+    return {"id": wb["id"], "filename": wb["filename"], "format": wb["format"],
+            "expires_in": max(0, round(wb["expires"] - time.monotonic())),
+            "active_sheet": wb["sheets"][wb["active"]].name if wb["sheets"] else None,
+            "sheets": [s.info() for s in wb["sheets"]]}
+
+_workbook_sessions = _WorkbookSessions(SESSION_MAX_BYTES, SESSION_TTL)
+
+# ========= 受付制御（同時解析数の上限と 429） =========
+# 重い解析を伴うエンドポイントは、同時実行 ADMIT_MAX_ACTIVE 件 + 待ち ADMIT_MAX_QUEUE 件まで受け付ける。
+# それを超えたら待たせずに 429 + Retry-After を返し、ヘルスチェック（/）は常にすぐ応答できるようにする。
+
+class _Overloaded(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("server busy")
+        self.retry_after = retry_after
+
+class _Admission:
+    def __init__(self, max_active: int, max_queue: int, queue_timeout: float):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+        self._stats: Dict[str, Dict] = {}
+        self._service_avg = 1.0  # 1件あたりの処理時間の移動平均（Retry-After の見積もり用）
+
+    def _ep(self, endpoint: str) -> Dict:
+        st = self._stats.get(endpoint)
+        if st is None:
+            st = self._stats[endpoint] = {
+                "active": 0, "waiting": 0, "admitted": 0, "rejected": 0,
+                "wait_seconds_total": 0.0, "wait_seconds_max": 0.0,
+            }
+        return st
+
+    def _retry_after(self) -> int:
+        per_slot = self._service_avg * (self.waiting + 1) / max(self.max_active, 1)
+        return max(1, int(per_slot + 0.999))
+
+    def acquire(self, endpoint: str) -> float:
+        t0 = time.monotonic()
+        with self._cond:
+            st = self._ep(endpoint)
+            if self.active >= self.max_active and self.waiting >= self.max_queue:
+                st["rejected"] += 1
+                raise _Overloaded(self._retry_after())
+            self.waiting += 1
+            st["waiting"] += 1
+            try:
+                ok = self._cond.wait_for(lambda: self.active < self.max_active, timeout=self.queue_timeout)
+            finally:
+                self.waiting -= 1
+                st["waiting"] -= 1
+            if not ok:
+                st["rejected"] += 1
+                raise _Overloaded(self._retry_after())
+            self.active += 1
+            st["active"] += 1
+            st["admitted"] += 1
+            waited = time.monotonic() - t0
+            st["wait_seconds_total"] += waited
+            st["wait_seconds_max"] = max(st["wait_seconds_max"], waited)
+        return time.monotonic()
+
+    def release(self, endpoint: str, started: float) -> None:
+        with self._cond:
+            self.active -= 1
+            self._ep(endpoint)["active"] -= 1
+            self._service_avg = 0.9 * self._service_avg + 0.1 * (time.monotonic() - started)
+            self._cond.notify()
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                "max_active": self.max_active,
+                "max_queue": self.max_queue,
+                "active": self.active,
+                "waiting": self.waiting,
+                "endpoints": {k: dict(v) for k, v in self._stats.items()},
+            }
+
+_admission = _Admission(ADMIT_MAX_ACTIVE, ADMIT_MAX_QUEUE, ADMIT_QUEUE_TIMEOUT)
+
+def _admitted(endpoint: str):
+    # ストリーミング応答は送信が終わるまで枠（と解析の締め切り）を持ち続ける
+    def deco(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                started = _admission.acquire(endpoint)
+            except _Overloaded as e:
+                resp = jsonify({"error": "server busy, retry later"})
+                resp.status_code = 429
+                resp.headers["Retry-After"] = str(e.retry_after)
+                return resp
+            _set_deadline(REQUEST_TIMEOUT, "request time budget exceeded")
+
+            def done():
+                _set_deadline(0)
+                _admission.release(endpoint, started)
+            try:
+                resp = app.make_response(view(*args, **kwargs))
+            except BaseException:
+                done()
+                raise
+            if resp.is_streamed:
+                resp.call_on_close(done)
+            else:
+                done()
+            return resp
+        return wrapper
+    return deco
+
+# ========= 計測（ステージ別の所要時間と /metrics） =========
+# read / open / scan / normalize / html / serialize の所要時間を入力形式（xlsx/xls/msg/eml）別に積算し、
+# リクエスト終了時にヒストグラムへ記録する。プールのワーカーで測った分は結果と一緒に親へ戻して合算する。
+# 値はプロセス単位の集計（gunicorn で複数ワーカーを立てる場合はワーカーごと）。
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1KiB .. 256MiB
+
+_METRIC_DEFS = {
+    "excel_api_stage_seconds": ("histogram", "Time spent per processing stage and input format.", _LATENCY_BUCKETS),
+    "excel_api_request_seconds": ("histogram", "Request duration until the response is closed.", _LATENCY_BUCKETS),
+    "excel_api_input_bytes": ("histogram", "Size of each input file by format.", _BYTES_BUCKETS),
+    "excel_api_requests_total": ("counter", "Requests by endpoint and status code.", None),
+    "excel_api_cells_emitted_total": ("counter", "Non-empty cells written to responses.", None),
+    "excel_api_truncations_total": ("counter", "Extractions cut off by a cell limit.", None),
+    "excel_api_jobs_total": ("counter", "Background jobs finished by type and final status.", None),
+}
+
+_timing = threading.local()  # acc: {(形式, ステージ): 秒} 計測中のみ dict
+
+class _Metrics:
+    def __init__(self, defs: Dict):
+        self.defs = defs
+        self._lock = threading.Lock()
+        self._series: Dict[tuple, object] = {}  # (名前, ラベル) -> カウンタ値 / [バケット別件数, 合計, 件数]
+
+    def inc(self, name: str, labels: tuple, n=1) -> None:
+        key = (name, labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + n
+
+    def observe(self, name: str, labels: tuple, value: float) -> None:
+        buckets = self.defs[name][2]
+        key = (name, labels)
+        with self._lock:
+            h = self._series.get(key)
+            if h is None:
+                h = self._series[key] = [[0] * len(buckets), 0.0, 0]
+            i = bisect.bisect_left(buckets, value)
+            if i < len(buckets):
+                h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = sorted((k, v if not isinstance(v, list) else [list(v[0]), v[1], v[2]])
+                            for k, v in self._series.items())
+        out = []
+        for name, (kind, help_s, buckets) in self.defs.items():
+            out.append(f"# HELP {name} {help_s}")
+            out.append(f"# TYPE {name} {kind}")
+            for (n, labels), v in series:
+                if n != name:
+                    continue
+                if kind == "counter":
+                    out.append(f"{name}{_prom_labels(labels)} {v}")
+                    continue
+                counts, total, count = v
+                cum = 0
+                for le, c in zip(buckets, counts):
+                    cum += c
+                    out.append(f"{name}_bucket{_prom_labels(labels + (('le', str(le)),))} {cum}")
+                out.append(f"{name}_bucket{_prom_labels(labels + (('le', '+Inf'),))} {count}")
+                out.append(f"{name}_sum{_prom_labels(labels)} {total}")
+                out.append(f"{name}_count{_prom_labels(labels)} {count}")
+        return out
+
+_metrics = _Metrics(_METRIC_DEFS)
+
+def _prom_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+def _stage_add(fmt: str, stage: str, seconds: float) -> None:
+    acc = getattr(_timing, "acc", None)
+    if acc is not None:
+        key = (fmt, stage)
+        acc[key] = acc.get(key, 0.0) + seconds
+
+@contextmanager
+def _stage(fmt: str, stage: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stage_add(fmt, stage, time.perf_counter() - t0)
+
+@contextmanager
+def _timing_scope():
+    # 新しい積算先に切り替え、抜けたら元に戻す（プールのワーカーで1タスクぶんを測る用）
+    prev = getattr(_timing, "acc", None)
+    _timing.acc = acc = {}
+    try:
+        yield acc
+    finally:
+        _timing.acc = prev
+
+def _timing_merge(stages: Dict) -> None:
+    # ワーカーから戻った計測値を合算する。リクエスト外なら1件ぶんとしてそのまま記録
+    if getattr(_timing, "acc", None) is None:
+        _observe_stages(stages)
+        return
+    for (fmt, stage), seconds in stages.items():
+        _stage_add(fmt, stage, seconds)
+
+def _observe_stages(stages: Dict) -> None:
+    for (fmt, stage), seconds in stages.items():
+        _metrics.observe("excel_api_stage_seconds", (("format", fmt), ("stage", stage)), seconds)
+
+def _timed_rows(fmt: str, rows):
+    # 行の取り出しにかかった時間のうち、open / normalize として測った分を除いた残りを scan とする
+    it = iter(rows)
+    try:
+        while True:
+            acc = getattr(_timing, "acc", None)
+            if acc is None:
+                lines = next(it, None)
+            else:
+                nested = acc.get((fmt, "open"), 0.0) + acc.get((fmt, "normalize"), 0.0)
+                t0 = time.perf_counter()
+                lines = next(it, None)
+                nested = acc.get((fmt, "open"), 0.0) + acc.get((fmt, "normalize"), 0.0) - nested
+                _stage_add(fmt, "scan", time.perf_counter() - t0 - nested)
+            if lines is None:
+                return
+            yield lines
+    finally:
+        close = getattr(it, "close", None)
+        if close is not None:
+            close()
+
+def _observe_input(fmt: str, nbytes: int) -> None:
+    _metrics.observe("excel_api_input_bytes", (("format", fmt),), nbytes)
+
+def _observe_cells(fmt: str, lines: List[str]) -> None:
+    cells = truncated = 0
+    for line in lines:
+        if not line.startswith("#"):
+            cells += bool(line)
+        elif line == "# ...truncated...":
+            truncated += 1
+    if cells:
+        _metrics.inc("excel_api_cells_emitted_total", (("format", fmt),), cells)
+        _job_progress(cells=cells)
+    if truncated:
+        _metrics.inc("excel_api_truncations_total", (("format", fmt),), truncated)
+
+def _observe_doc(fmt: str, doc: Dict) -> None:
+    cells = sum(len(sh["row"]) for sh in doc["sheets"])
+    truncated = sum(sh["truncated"] for sh in doc["sheets"])
+    if cells:
+        _metrics.inc("excel_api_cells_emitted_total", (("format", fmt),), cells)
+        _job_progress(cells=cells)
+    if truncated:
+        _metrics.inc("excel_api_truncations_total", (("format", fmt),), truncated)
+
+def _server_timing(stages: Dict, total: float) -> str:
+    parts = [f"{fmt}-{stage};dur={seconds * 1000:.1f}" for (fmt, stage), seconds in stages.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+@app.before_request
+def _timing_begin():
+    g.timing_t0 = time.perf_counter()
+    _timing.acc = {}
+
+@app.after_request
+def _timing_end(resp):
+    # Server-Timing はクエリの timing=true か X-Timing: true ヘッダーで付ける（ストリーミング応答は送信開始までの分）。
+    # フォームは見ない（429 や早い段階の 400 でも multipart の本体を読み込んでしまうため）
+    acc = getattr(_timing, "acc", None) or {}
+    t0 = g.get("timing_t0", time.perf_counter())
+    timing_on = "true" in (request.args.get("timing", "").lower(), request.headers.get("X-Timing", "").lower())
+    if timing_on:
+        resp.headers["Server-Timing"] = _server_timing(acc, time.perf_counter() - t0)
+    labels = (("endpoint", request.endpoint or "unknown"),)
+    code = resp.status_code
+
+    def finish():
+        if getattr(_timing, "acc", None) is acc:
+            _timing.acc = None
+        _observe_stages(acc)
+        _metrics.observe("excel_api_request_seconds", labels, time.perf_counter() - t0)
+        _metrics.inc("excel_api_requests_total", labels + (("code", str(code)),))
+
+    if resp.is_streamed:
+        resp.call_on_close(finish)  # 送信中の解析分も同じ積算先に入る
+    else:
+        finish()
+    return resp
+
+# ========= 起動時の準備（gunicorn の preload 用） =========
+# 解析ライブラリは最初に使うときに読み込む。gunicorn を preload_app = True で動かすときは、マスターで
+# warm_up() を呼んでおくと（gunicorn.conf.py の on_starting、または PRELOAD_BACKENDS=true）、
+# 読み込み済みのモジュールを fork したワーカーが copy-on-write で共有し、各ワーカーの初回リクエストも待たない。
+
+_BACKEND_MODULES = (
+    "openpyxl", "openpyxl.styles.numbers", "openpyxl.utils.datetime",  # .xlsx（日付変換はストリーミングでも使う）
+    "xlrd",  # .xls
+    "olefile", "extract_msg",  # .msg
+)
+
+def warm_up() -> None:
+    for name in _BACKEND_MODULES:
+        importlib.import_module(name)
+    # ここまでに作ったオブジェクトは以後の GC で走査しない（走査で参照カウントを書き換えると共有ページがコピーされる）
+    gc.freeze()
+
+# ========= 出力形式（tsv / json / ndjson / msgpack） =========
+# format パラメータが優先。無ければ Accept に挙がった形式のうち q の高いものを使う。
+# ただし Accept に text/plain（TSV）も挙がっていれば TSV のまま（axios の既定
+# "application/json, text/plain, */*" のように、どれでも受けるクライアントの応答を変えない）。
+# json / ndjson / msgpack はシートごとに行・列（1始まりの整数）・値・型を並列の配列で返す。
+
+_OUTPUT_MIMETYPES = {
+    "tsv": "text/plain; charset=utf-8",
+    "json": "application/json; charset=utf-8",
+    "ndjson": "application/x-ndjson; charset=utf-8",
+    "msgpack": "application/x-msgpack",
+}
+_ACCEPT_FORMATS = {
+    "text/plain": "tsv",
+    "text/tab-separated-values": "tsv",
+    "application/json": "json",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/x-msgpack": "msgpack",
+    "application/msgpack": "msgpack",
+    "application/vnd.msgpack": "msgpack",
+}
+
+class _NotAcceptable(Exception):
+    pass
+
+def _output_format(accept_json: bool = True) -> str:
+    # accept_json=False: /extract_mail は従来から JSON を返すので、Accept: application/json は従来形式のまま
+    req = request.values.get("format")
+    if req:
+        out = req.strip().lower()
+        if out not in _OUTPUT_MIMETYPES:
+            raise ValueError(f"unknown format: {req} (tsv, json, ndjson, msgpack)")
+    else:
+        acceptable = [_ACCEPT_FORMATS.get(mt.lower()) for mt, q in request.accept_mimetypes if q > 0]
+        picked = [fmt for fmt in acceptable if fmt and (accept_json or fmt != "json")]
+        out = picked[0] if picked and "tsv" not in acceptable else "tsv"
+    if out == "msgpack" and msgpack is None:
+        raise _NotAcceptable("msgpack output is not available (pip install msgpack)")
+    return out
+
+def _dump_json(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def _ndjson_cells(doc: Dict):
+    # 1行 = 1シートの1行ぶん。打ち切られたシートは最後に truncated の行を付ける
+    for sh in doc["sheets"]:
+        rows, cols, values, types = sh["row"], sh["col"], sh["value"], sh["type"]
+        i, n = 0, len(rows)
+        while i < n:
+            j = i + 1
+            while j < n and rows[j] == rows[i]:
+                j += 1
+            yield _dump_json({"sheet": sh["name"], "row": rows[i], "col": cols[i:j],
+                              "value": values[i:j], "type": types[i:j]})
+            i = j
+        if sh["truncated"]:
+            yield _dump_json({"sheet": sh["name"], "truncated": True})
+
+def _serialize(out: str, doc: Dict, ndjson_lines):
+    if out == "msgpack":
+        return msgpack.packb(doc, use_bin_type=True)
+    if out == "ndjson":
+        return "".join(line + "\n" for line in ndjson_lines)
+    return _dump_json(doc)
+
 # ========= Flaskエンドポイント =========
 
+@app.errorhandler(RequestEntityTooLarge)
+def _upload_too_large(e):
+    return jsonify({"error": f"upload too large (max {MAX_UPLOAD_BYTES} bytes)"}), 413
+
 @app.route("/", methods=["GET"])
 def health():
     return jsonify({
         "ok": True,
         "message": "excel-api (xlsx/xls sparse + mail .msg/.eml)",
-        "endpoint": ["/extract", "/extract_mail"]
+        "endpoint": ["/extract", "/extract_mail", "/extract_batch", "/workbooks", "/jobs", "/cache_stats", "/queue_stats", "/metrics"]
     })
 
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    return jsonify(_extract_cache.stats())
+
+@app.route("/queue_stats", methods=["GET"])
+def queue_stats():
+    return jsonify(_admission.stats())
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # Prometheus テキスト形式。キャッシュと受付制御の状態もあわせて出す
+    out = _metrics.render()
+    cs = _extract_cache.stats()
+    for key, kind in (("hits", "counter"), ("misses", "counter"), ("evictions", "counter"),
+                      ("disk_hits", "counter"), ("disk_writes", "counter"), ("disk_evictions", "counter"),
+                      ("entries", "gauge"), ("bytes", "gauge")):
+        name = f"excel_api_cache_{key}" + ("_total" if kind == "counter" else "")
+        out += [f"# TYPE {name} {kind}", f"{name} {cs[key]}"]
+    qs = _admission.stats()
+    ss = _workbook_sessions.stats()
+    out += ["# TYPE excel_api_workbook_sessions gauge", f"excel_api_workbook_sessions {ss['sessions']}",
+            "# TYPE excel_api_workbook_session_bytes gauge", f"excel_api_workbook_session_bytes {ss['bytes']}"]
+    out.append("# TYPE excel_api_jobs gauge")
+    for status, n in _job_queue.stats().items():
+        out.append(f"excel_api_jobs{_prom_labels((('status', status),))} {n}")
+    out += ["# TYPE excel_api_admission_active gauge", f"excel_api_admission_active {qs['active']}",
+            "# TYPE excel_api_admission_waiting gauge", f"excel_api_admission_waiting {qs['waiting']}"]
+    for key in ("admitted", "rejected", "wait_seconds"):
+        name = f"excel_api_admission_{key}_total"
+        out.append(f"# TYPE {name} counter")
+        for ep, st in sorted(qs["endpoints"].items()):
+            out.append(f"{name}{_prom_labels((('endpoint', ep),))} {st[key + '_total' if key == 'wait_seconds' else key]}")
+    return Response("\n".join(out) + "\n", mimetype="text/plain; version=0.0.4; charset=utf-8")
+
 @app.route("/extract", methods=["POST"])
+@_admitted("extract")
 def extract():
+    t0 = time.perf_counter()
     f = request.files.get("file")
     if not f:
         return jsonify({"error": "file is required (multipart/form-data)"}), 400
@@ -425,124 +2152,1312 @@ def extract():
     bom_on = (request.form.get("bom", "true").lower() != "false")
     inline_on = (request.form.get("inline", "true").lower() != "false")
     sheet_req = request.form.get("sheet")
+    sheets_req = request.form.get("sheets")  # "all" / "名前,2,3"：1回開いて複数シートを順に抽出
+    stream_on = (request.form.get("stream", "false").lower() == "true")
+    try:
+        out = _output_format()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except _NotAcceptable as e:
+        return jsonify({"error": str(e)}), 406
 
     data = f.read()
     if not data:
         return jsonify({"error": "empty file"}), 400
+    fmt = _excel_format(f.filename, data)
+    _stage_add(fmt, "read", time.perf_counter() - t0)
+    _observe_input(fmt, len(data))
+
+    headers = {}
+    if not inline_on:
+        headers["Content-Disposition"] = f'attachment; filename="extract.{out}"'
+
+    if stream_on and out == "tsv":
+        rows = _iter_excel_sparse_cached(data, filename=f.filename, sheet_req=sheet_req, sheets_req=sheets_req)
+        # 開けないブックは従来どおり 400 にするため、先頭行だけ先に読む
+        try:
+            first = next(rows, None)
+        except _BudgetExceeded as e:
+            return jsonify({"error": f"failed to read workbook: {e}"}), 413
+        except Exception as e:
+            return jsonify({"error": f"failed to read workbook: {e}"}), 400
+        return Response(_stream_tsv(first, rows, bom_on), mimetype="text/plain; charset=utf-8", headers=headers)
 
     try:
-        payload = _excel_sparse_from_bytes(data, filename=f.filename, sheet_req=sheet_req)
+        body, mimetype = _extract_body(data, f.filename, out, sheet_req, sheets_req, bom_on)
+    except _BudgetExceeded as e:
+        return jsonify({"error": f"failed to read workbook: {e}"}), 413
     except Exception as e:
         return jsonify({"error": f"failed to read workbook: {e}"}), 400
-
+    return Response(body, mimetype=mimetype, headers=headers)
+
+def _extract_body(data: bytes, filename: str | None, out: str,
+                  sheet_req: str | None = None, sheets_req: str | None = None, bom_on: bool = True) -> tuple:
+    # /extract の応答本体と mimetype（ストリーミング以外）。/jobs からも使う
+    if out != "tsv":
+        # 構造化出力は BOM も stream も対象外
+        doc = _excel_cells_from_bytes(data, filename=filename, sheet_req=sheet_req, sheets_req=sheets_req)
+        with _stage(_excel_format(filename, data), "serialize"):
+            body = _serialize(out, doc, _ndjson_cells(doc))
+        return body, _OUTPUT_MIMETYPES[out]
+    payload = _excel_sparse_from_bytes(data, filename=filename, sheet_req=sheet_req, sheets_req=sheets_req)
     if bom_on:
         payload = "\ufeff" + payload
-
-    headers = {}
-    if not inline_on:
-        headers["Content-Disposition"] = 'attachment; filename="extract.tsv"'
-    return Response(payload, mimetype="text/plain; charset=utf-8", headers=headers)
+    return payload, _OUTPUT_MIMETYPES["tsv"]
+
+def _stream_tsv(first, rows, bom_on: bool):
+    # 行単位でチャンクを送る。改行は行の間にだけ入れ、非ストリーミング時と同じバイト列にする
+    head = "\ufeff" if bom_on else ""
+    if first is None:
+        if head:
+            yield head
+        return
+    yield head + "\n".join(first)
+    try:
+        for lines in rows:
+            yield "\n" + "\n".join(lines)
+    except Exception as e:
+        yield f"\n# ERROR: failed to read workbook: {e}"
 
 @app.route("/extract_mail", methods=["POST"])
+@_admitted("extract_mail")
 def extract_mail():
+    t0 = time.perf_counter()
     up = request.files.get("file")
     if not up:
         return jsonify({"error": "file is required (multipart/form-data)"}), 400
 
-    filename = (up.filename or "").lower()
+    try:
+        out = _output_format(accept_json=False)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except _NotAcceptable as e:
+        return jsonify({"error": str(e)}), 406
+
     data = up.read()
+    read_s = time.perf_counter() - t0
+
+    # 拡張子は見ずに中身で振り分け、解析は1回だけ。OLE なら .msg、それ以外は .eml として読む
+    kind = _sniff_format(data)
+    if kind in ("zip", "xls"):
+        return jsonify({"error": f"unsupported or unreadable mail file: looks like a workbook ({kind})"}), 400
 
     try:
-        if filename.endswith(".msg") or _looks_like_msg(data):
-            payload = _handle_msg_bytes(data)
-        elif filename.endswith(".eml") or _looks_like_eml(data):
-            payload = _handle_eml_bytes(data)
-        else:
-            try:
-                payload = _handle_eml_bytes(data)
-            except Exception:
-                try:
-                    payload = _handle_msg_bytes(data)
-                except Exception as e:
-                    return jsonify({"error": f"unsupported or unreadable mail file: {e}"}), 400
-        return Response(json.dumps(payload, ensure_ascii=False),
-                        mimetype="application/json; charset=utf-8")
+        body, mimetype = _extract_mail_body(data, kind, out, read_s)
+    except _BudgetExceeded as e:
+        return jsonify({"error": f"failed to process mail: {e}"}), 413
     except Exception as e:
         return jsonify({"error": f"failed to process mail: {e}"}), 400
+    return Response(body, mimetype=mimetype)
 
-# ========= メール処理 =========
+def _extract_mail_body(data: bytes, kind: str | None, out: str, read_s: float = 0.0) -> tuple:
+    # /extract_mail の応答本体と mimetype。kind は _sniff_format の結果。/jobs からも使う
+    typed = out != "tsv"
+    if kind in ("msg", "ole"):
+        payload = _handle_msg_bytes(data, typed)
+    else:
+        payload = _handle_eml_bytes(data, typed)
+    _stage_add(payload["format"], "read", read_s)
+    with _stage(payload["format"], "serialize"):
+        if not typed:
+            return json.dumps(payload, ensure_ascii=False), "application/json; charset=utf-8"
+        # ndjson は1行目が本文、以降は添付1件につき1行
+        head = {k: v for k, v in payload.items() if k != "excel_attachments"}
+        body = _serialize(out, payload, [_dump_json(head)] + [_dump_json(a) for a in payload["excel_attachments"]])
+    return body, _OUTPUT_MIMETYPES[out]
+
+@app.route("/extract_batch", methods=["POST"])
+@_admitted("extract_batch")
+def extract_batch():
+    """
+    複数ファイルをまとめて抽出し、終わったものから1行1件の NDJSON で返す。
+    multipart/form-data:
+      - file: (必須) .xlsx/.xls を複数、または .zip を1つ
+      - sheet: オプション（全ファイル共通）
+    """
+    ups = request.files.getlist("file")
+    if not ups:
+        return jsonify({"error": "file is required (multipart/form-data)"}), 400
+    sheet_req = request.form.get("sheet")
 
-def _looks_like_msg(b: bytes) -> bool:
-    return len(b) >= 8 and b[:8] == b"\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1"
+    items = []
+    if len(ups) == 1 and (ups[0].filename or "").lower().endswith(".zip"):
+        try:
+            items = _batch_items_from_zip(ups[0].read())
+        except _TooManyFiles:
+            return jsonify({"error": f"too many files (max {MAX_BATCH_FILES})"}), 400
+        except zipfile.BadZipFile as e:
+            return jsonify({"error": f"failed to read zip archive: {e}"}), 400
+        except _BudgetExceeded as e:
+            return jsonify({"error": f"failed to read zip archive: {e}"}), 413
+    else:
+        for up in ups:
+            items.append((up.filename or "", up.read()))
+    if len(items) > MAX_BATCH_FILES:
+        return jsonify({"error": f"too many files (max {MAX_BATCH_FILES})"}), 400
+
+    for name, data in items:
+        _observe_input(_excel_format(name, data), len(data))
+
+    def generate():
+        for i, result in _iter_extract_batch(items, sheet_req):
+            rec = {"index": i, "filename": items[i][0]}
+            if isinstance(result, Exception):
+                rec.update(ok=False, error=f"failed to read workbook: {result}")
+            else:
+                rec.update(ok=True, cells=result)
+            with _stage(_excel_format(*items[i]), "serialize"):
+                line = json.dumps(rec, ensure_ascii=False) + "\n"
+            yield line
+
+    return Response(generate(), mimetype="application/x-ndjson; charset=utf-8")
+
+class _TooManyFiles(Exception):
+    pass
+
+def _batch_items_from_zip(b: bytes) -> List[tuple]:
+    # 数と展開後サイズは中央ディレクトリで先に確かめてから読む（リクエストのスレッドで展開するため）
+    with zipfile.ZipFile(BytesIO(b)) as zf:
+        picked = [info for info in zf.infolist()
+                  if not info.is_dir() and not info.filename.startswith("__MACOSX/") and _is_excel_filename(info.filename)]
+        if len(picked) > MAX_BATCH_FILES:
+            raise _TooManyFiles()
+        _check_zip_members(zf, picked)
+        return [(info.filename, zf.read(info)) for info in picked]
+
+@app.route("/workbooks", methods=["POST"])
+@_admitted("workbooks")
+def create_workbook():
+    """
+    ブックを1回だけアップロードしてセッションを作る。以後は /workbooks/<id>/cells で範囲を問い合わせる。
+    multipart/form-data:
+      - file: (必須) .xlsx/.xls
+    """
+    t0 = time.perf_counter()
+    f = request.files.get("file")
+    if not f:
+        return jsonify({"error": "file is required (multipart/form-data)"}), 400
+    data = f.read()
+    if not data:
+        return jsonify({"error": "empty file"}), 400
+    fmt = _excel_format(f.filename, data)
+    _stage_add(fmt, "read", time.perf_counter() - t0)
+    _observe_input(fmt, len(data))
 
-def _looks_like_eml(b: bytes) -> bool:
-    head = b[:512].decode("utf-8", errors="ignore")
-    return ("From:" in head or "Subject:" in head) and "\n\n" in head
+    try:
+        sheets, active = _run_parse(_build_workbook_index, data, f.filename)
+    except _BudgetExceeded as e:
+        return jsonify({"error": f"failed to read workbook: {e}"}), 413
+    except Exception as e:
+        return jsonify({"error": f"failed to read workbook: {e}"}), 400
+    wb = _workbook_sessions.put(f.filename or "", fmt, sheets, active)
+    if wb is None:
+        return jsonify({"error": "workbook too large for a session"}), 413
+    return jsonify(_session_info(wb)), 201
+
+@app.route("/workbooks/<sid>", methods=["GET"])
+def get_workbook(sid: str):
+    wb = _workbook_sessions.get(sid)
+    if wb is None:
+        return jsonify({"error": "workbook session not found or expired"}), 404
+    return jsonify(_session_info(wb))
+
+@app.route("/workbooks/<sid>", methods=["DELETE"])
+def delete_workbook(sid: str):
+    if not _workbook_sessions.delete(sid):
+        return jsonify({"error": "workbook session not found or expired"}), 404
+    return jsonify({"ok": True})
+
+@app.route("/workbooks/<sid>/cells", methods=["GET"])
+def workbook_cells(sid: str):
+    """
+    セッションの索引から範囲内の非空セルを 'A1<TAB>値' で返す（/extract と同じ書式）。
+    query:
+      - sheet: 名前 / 0始まり / 1始まり（省略時は /extract と同じく、xlsx はアクティブシート、.xls は先頭シート）
+      - range: "B15:AW80" / "B15" / "B:AW" / "15:80"（省略時はシート全体）
+      - bom: false で BOM を付けない
+    """
+    wb = _workbook_sessions.get(sid)
+    if wb is None:
+        return jsonify({"error": "workbook session not found or expired"}), 404
+    sheets = wb["sheets"]
+    sheet_req = request.args.get("sheet")
+    idx = _pick_sheet_index([s.name for s in sheets], sheet_req) if sheet_req else wb["active"]
+    if idx is None or idx >= len(sheets):
+        return jsonify({"error": f"sheet not found: {sheet_req}"}), 400
+    try:
+        r1, c1, r2, c2 = _parse_range(request.args.get("range"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    sheet = sheets[idx]
+    lines = sheet.query(r1, c1, r2, c2)
+    # 索引が上限で切れている場合、最後の行より下を含む範囲には truncated を付ける
+    if sheet.truncated and r2 >= sheet.rows[-1]:
+        lines.append("# ...truncated...")
+    _observe_cells(wb["format"], lines)
+
+    payload = "\n".join(lines)
+    if request.args.get("bom", "true").lower() != "false":
+        payload = "\ufeff" + payload
+    return Response(payload, mimetype="text/plain; charset=utf-8")
+
+# ========= 非同期ジョブ（/jobs） =========
+# 時間のかかる抽出を受け付けだけして id を返し、バックグラウンドで処理する。
+# キューは JOBS_DIR の SQLite（jobs.sqlite3）、入力と結果は同じ場所の <id>.in / <id>.out に置くので、
+# 再起動しても未処理のジョブは残る。処理中のジョブには持ち主（プロセスごとの乱数トークン）とリースの期限を書き、
+# 持ち主は生きている間リースを延ばし続ける。期限の切れたジョブ（持ち主のプロセスやコンテナが消えた）は再投入し、
+# _JOB_MAX_ATTEMPTS 回目でも終わらなければ失敗にする。PID は再起動後に使い回されるので持ち主の判定には使わない。
+# 処理スレッドは各プロセスに JOB_WORKERS 本ずつ立てる。
+# 解析は同期リクエストと同じ経路（キャッシュ）を通るが、プロセスプールはジョブ専用（JOB_WORKERS 個）を使うので、
+# JOB_TIMEOUT まで掛かるジョブが同期リクエストの解析ワーカーを塞ぐことはない。
+
+_JOB_MAX_ATTEMPTS = 3
+_JOB_POLL = 1.0            # 他プロセスが積んだジョブを拾う間隔（秒）
+_JOB_MAINTENANCE = 60.0    # 放置されたジョブの再投入と期限切れの掃除の間隔（秒）
+_JOB_PROGRESS_FLUSH = 0.5  # 進捗を書き込む最短間隔（秒）
+_JOB_LEASE = 60.0          # 処理中のジョブのリースの長さ（秒）。持ち主はこの 1/3 ごとに延ばす
+
+_job_local = threading.local()
+
+def _job_progress(**inc) -> None:
+    # ジョブの処理スレッド内でだけ進捗を数える（attachments_total / attachments_done / cells）
+    job = getattr(_job_local, "job", None)
+    if job is not None:
+        job.add(inc)
+
+def _job_budget(default: float) -> float:
+    return JOB_TIMEOUT if getattr(_job_local, "job", None) is not None else default
+
+class _JobProgress:
+    __slots__ = ("queue", "jid", "counts", "flushed")
+
+    def __init__(self, queue: "_JobQueue", jid: str):
+        self.queue = queue
+        self.jid = jid
+        self.counts = {"attachments_total": 0, "attachments_done": 0, "cells": 0}
+        self.flushed = 0.0
+
+    def add(self, inc: Dict) -> None:
+        for k, v in inc.items():
+            self.counts[k] += v
+        if time.monotonic() - self.flushed >= _JOB_PROGRESS_FLUSH:
+            self.flush()
+
+    def flush(self) -> None:
+        self.flushed = time.monotonic()
+        self.queue._execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(self.counts), self.jid))
+
+class _JobQueue:
+    def __init__(self, path: str, workers: int, ttl: float):
+        self.path = path
+        self.workers = workers
+        self.ttl = ttl
+        self._pid = None
+        self._token = None  # このプロセスの持ち主トークン（start で決める）
+        self._wake = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(os.path.join(self.path, "jobs.sqlite3"), timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _execute(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        with closing(self._connect()) as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def _file(self, jid: str, suffix: str) -> str:
+        return os.path.join(self.path, jid + suffix)
+
+    def _write(self, jid: str, suffix: str, data: bytes) -> None:
+        tmp = self._file(jid, suffix + ".tmp")
+        with open(tmp, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp, self._file(jid, suffix))
+
+    def _remove(self, jid: str, *suffixes: str) -> None:
+        for suffix in suffixes:
+            try:
+                os.remove(self._file(jid, suffix))
+            except FileNotFoundError:
+                pass
+
+    def _init_db(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, kind TEXT NOT NULL, filename TEXT, params TEXT NOT NULL,
+                status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, owner INTEGER,
+                progress TEXT, mimetype TEXT, code INTEGER, error TEXT,
+                created REAL NOT NULL, started REAL, finished REAL, token TEXT, lease REAL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+            # 持ち主が PID だけだった頃の DB には列を足す
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, decl in (("token", "TEXT"), ("lease", "REAL")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {decl}")
+
+    def start(self) -> None:
+        # プロセスごとに1回だけ処理スレッドを立てる（fork 後の子プロセスでは立て直す）
+        if self.workers <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._init_db()
+            self._token = secrets.token_hex(16)
+            self._wake = threading.Event()
+            self._maintain()
+            for i in range(self.workers):
+                threading.Thread(target=self._loop, name=f"excel-api-job-{i}", daemon=True).start()
+            threading.Thread(target=self._heartbeat, name="excel-api-job-lease", daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, kind: str, filename: str, params: Dict, data: bytes) -> str:
+        jid = secrets.token_urlsafe(16)
+        self._write(jid, ".in", data)
+        self._execute("INSERT INTO jobs (id, kind, filename, params, status, progress, created) "
+                      "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                      (jid, kind, filename, json.dumps(params), json.dumps(_JobProgress(self, jid).counts),
+                       time.time()))
+        if self._wake is not None:
+            self._wake.set()
+        return jid
+
+    def get(self, jid: str) -> sqlite3.Row | None:
+        rows = self._execute("SELECT * FROM jobs WHERE id = ?", (jid,))
+        return rows[0] if rows else None
+
+    def result(self, jid: str) -> bytes:
+        with open(self._file(jid, ".out"), "rb") as fp:
+            return fp.read()
+
+    def stats(self) -> Dict:
+        counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        if self._pid is not None:
+            for row in self._execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status"):
+                counts[row["status"]] = row["n"]
+        return counts
+
+    def _claim(self) -> sqlite3.Row | None:
+        # 複数プロセスから同時に拾わないよう、書き込みロックを取ってから選ぶ
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+                if row is not None:
+                    now = time.time()
+                    conn.execute("UPDATE jobs SET status = 'running', owner = ?, token = ?, lease = ?, "
+                                 "attempts = attempts + 1, started = ? WHERE id = ?",
+                                 (os.getpid(), self._token, now + _JOB_LEASE, now, row["id"]))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return row
+
+    def _loop(self) -> None:
+        next_maintenance = time.monotonic() + _JOB_MAINTENANCE
+        while True:
+            try:
+                if time.monotonic() >= next_maintenance:
+                    next_maintenance = time.monotonic() + _JOB_MAINTENANCE
+                    self._maintain()
+                row = self._claim()
+            except sqlite3.Error:
+                row = None
+            if row is None:
+                self._wake.wait(_JOB_POLL)
+                self._wake.clear()
+                continue
+            self._run(row)
 
-def _handle_msg_bytes(b: bytes) -> Dict:
-    with tempfile.NamedTemporaryFile(delete=True, suffix=".msg") as tmp:
-        tmp.write(b)
-        tmp.flush()
-        msg = extract_msg.Message(tmp.name)
+    def _heartbeat(self) -> None:
+        # このプロセスが処理中のジョブのリースを延ばす（解析が長引いて進捗が書かれない間も）
+        while True:
+            time.sleep(_JOB_LEASE / 3)
+            try:
+                self._execute("UPDATE jobs SET lease = ? WHERE token = ? AND status = 'running'",
+                              (time.time() + _JOB_LEASE, self._token))
+            except sqlite3.Error:
+                pass
+
+    def _maintain(self) -> None:
+        now = time.time()
+        with closing(self._connect()) as conn:
+            # リースの無い行は PID で持ち主を記録していた頃のもの（再起動前のプロセス）なので期限切れと同じに扱う
+            stale = conn.execute("SELECT id, attempts FROM jobs WHERE status = 'running' "
+                                 "AND (lease IS NULL OR lease < ?)", (now,)).fetchall()
+            for row in stale:
+                if row["attempts"] >= _JOB_MAX_ATTEMPTS:
+                    conn.execute("UPDATE jobs SET status = 'failed', code = 500, error = ?, finished = ? "
+                                 "WHERE id = ? AND status = 'running'",
+                                 (f"job abandoned after {row['attempts']} attempts", now, row["id"]))
+                    self._remove(row["id"], ".in")
+                else:
+                    conn.execute("UPDATE jobs SET status = 'queued', owner = NULL, token = NULL, lease = NULL "
+                                 "WHERE id = ? AND status = 'running'", (row["id"],))
+            expired = conn.execute("SELECT id FROM jobs WHERE status IN ('done', 'failed') AND finished < ?",
+                                   (now - self.ttl,)).fetchall()
+            for row in expired:
+                conn.execute("DELETE FROM jobs WHERE id = ?", (row["id"],))
+                self._remove(row["id"], ".in", ".out")
+
+    def _run(self, row: sqlite3.Row) -> None:
+        jid, kind = row["id"], row["kind"]
+        progress = _JobProgress(self, jid)
+        _job_local.job = progress
+        _set_deadline(JOB_TIMEOUT, "job time budget exceeded")
+        try:
+            with _timing_scope() as acc:
+                with open(self._file(jid, ".in"), "rb") as fp:
+                    data = fp.read()
+                body, mimetype = _run_job(kind, data, row["filename"], json.loads(row["params"]))
+            _observe_stages(acc)
+            self._write(jid, ".out", body.encode("utf-8") if isinstance(body, str) else body)
+            status, code, error = "done", 200, None
+        except _BudgetExceeded as e:
+            status, code, error, mimetype = "failed", 413, f"{_JOB_ERRORS.get(kind, '')}{e}", None
+        except Exception as e:
+            status, code, error, mimetype = "failed", 400, f"{_JOB_ERRORS.get(kind, '')}{e}", None
+        finally:
+            _job_local.job = None
+            _set_deadline(0)
+        progress.flush()
+        # リースが切れて他で再投入された後なら、そちらの状態と入力には触らない
+        with closing(self._connect()) as conn:
+            owned = conn.execute("UPDATE jobs SET status = ?, code = ?, error = ?, mimetype = ?, finished = ? "
+                                 "WHERE id = ? AND token = ?",
+                                 (status, code, error, mimetype, time.time(), jid, self._token)).rowcount
+        if owned:
+            self._remove(jid, ".in")
+        _metrics.inc("excel_api_jobs_total", (("kind", kind), ("status", status)))
+
+_JOB_ERRORS = {"extract": "failed to read workbook: ", "extract_mail": "failed to process mail: "}
+
+def _run_job(kind: str, data: bytes, filename: str | None, params: Dict) -> tuple:
+    if kind == "extract_mail":
+        return _extract_mail_body(data, _sniff_format(data), params["format"])
+    _observe_input(_excel_format(filename, data), len(data))
+    return _extract_body(data, filename, params["format"], params.get("sheet"), params.get("sheets"),
+                         params.get("bom", True))
+
+def _job_info(row: sqlite3.Row) -> Dict:
+    info = {"id": row["id"], "type": row["kind"], "filename": row["filename"], "status": row["status"],
+            "attempts": row["attempts"], "progress": json.loads(row["progress"] or "{}"),
+            "created": row["created"], "started": row["started"], "finished": row["finished"]}
+    if row["status"] == "failed":
+        info.update(code=row["code"], error=row["error"])
+    return info
+
+_job_queue = _JobQueue(JOBS_DIR, JOB_WORKERS, JOB_TTL)
+
+@app.before_request
+def _start_job_workers():
+    # 処理スレッドはリクエストを受けたプロセスで立てる（gunicorn の preload でマスターに立てない）
+    try:
+        _job_queue.start()
+    except (OSError, sqlite3.Error):
+        pass  # キューを置けない場合は /jobs が 503 を返す
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """
+    抽出をジョブとして受け付け、id を返す（202）。状態と結果は /jobs/<id> で取る。
+    multipart/form-data:
+      - file: (必須) .xlsx/.xls または .msg/.eml
+      - type: extract / extract_mail（省略時は中身で判定）
+      - sheet, sheets, bom: /extract と同じ（type=extract のみ）
+      - format: tsv / json / ndjson / msgpack（Accept でも可。extract_mail の tsv は従来の JSON）
+    """
+    if _job_queue.workers <= 0 or _job_queue._pid != os.getpid():
+        return jsonify({"error": "job queue is not available"}), 503
+    f = request.files.get("file")
+    if not f:
+        return jsonify({"error": "file is required (multipart/form-data)"}), 400
+    data = f.read()
+    if not data:
+        return jsonify({"error": "empty file"}), 400
+
+    sniffed = _sniff_format(data)
+    kind = request.form.get("type")
+    if not kind:
+        ext = os.path.splitext(f.filename or "")[1].lower()
+        mail = sniffed in ("msg", "eml") or (sniffed in (None, "ole") and ext in (".msg", ".eml"))
+        kind = "extract_mail" if mail else "extract"
+    if kind not in ("extract", "extract_mail"):
+        return jsonify({"error": f"unsupported job type: {kind} (expected extract / extract_mail)"}), 400
+    if kind == "extract_mail" and sniffed in ("zip", "xls"):
+        return jsonify({"error": f"unsupported or unreadable mail file: looks like a workbook ({sniffed})"}), 400
+    try:
+        out = _output_format(accept_json=(kind == "extract"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except _NotAcceptable as e:
+        return jsonify({"error": str(e)}), 406
+
+    params = {"format": out}
+    if kind == "extract":
+        params.update(sheet=request.form.get("sheet"), sheets=request.form.get("sheets"),
+                      bom=(request.form.get("bom", "true").lower() != "false"))
+    try:
+        jid = _job_queue.submit(kind, f.filename or "", params, data)
+    except (OSError, sqlite3.Error) as e:
+        return jsonify({"error": f"failed to queue job: {e}"}), 503
+    return jsonify(_job_info(_job_queue.get(jid))), 202, {"Location": f"/jobs/{jid}"}
+
+@app.route("/jobs/<jid>", methods=["GET"])
+def get_job(jid: str):
+    # 終わっていれば結果も含める（msgpack は result_url からのみ）
+    row = _job_queue.get(jid) if _job_queue._pid is not None else None
+    if row is None:
+        return jsonify({"error": "job not found or expired"}), 404
+    info = _job_info(row)
+    if row["status"] == "done":
+        info["result_url"] = f"/jobs/{jid}/result"
+        info["mimetype"] = row["mimetype"]
+        mimetype = row["mimetype"] or ""
+        if not mimetype.startswith("application/x-msgpack"):
+            body = _job_queue.result(jid).decode("utf-8")
+            info["result"] = json.loads(body) if mimetype.startswith("application/json") else body
+    return jsonify(info)
+
+@app.route("/jobs/<jid>/result", methods=["GET"])
+def get_job_result(jid: str):
+    row = _job_queue.get(jid) if _job_queue._pid is not None else None
+    if row is None:
+        return jsonify({"error": "job not found or expired"}), 404
+    if row["status"] == "failed":
+        return jsonify({"error": row["error"]}), row["code"]
+    if row["status"] != "done":
+        return jsonify({"error": f"job is {row['status']}"}), 409
+    return Response(_job_queue.result(jid), mimetype=row["mimetype"])
 
-    raw_text = to_str(getattr(msg, "body", "") or "")
-    raw_html = getattr(msg, "bodyHTML", "") or ""
-    body_text = raw_text or _html_to_text(raw_html)
+# ========= メール処理 =========
 
-    excel_results: List[Dict] = []
-    for att in msg.attachments:
-        name = getattr(att, "longFilename", "") or getattr(att, "shortFilename", "") or "attachment"
+# .msg は OLE のストリームを olefile で直接読み、本文と Excel 添付だけを取り出す。
+# extract-msg と結果が変わりうるもの（8bit 文字列、RTF にしか本文が無い、埋め込みオブジェクトの添付）は
+# None を返して extract-msg に任せる。
+
+_MSG_ATTACH_PREFIX = "__attach_version1.0_"
+_MSG_STORE_SUPPORT_MASK = 0x340D0003
+_MSG_STORE_UNICODE_OK = 0x00040000
+
+def _read_msg_direct(src, trail: tuple = ()):
+    # (本文テキスト, HTML 本文 bytes, [(入れ子の経路, データ, Excel か)]) を返す。trail はこのメッセージまでの経路
+    import olefile  # extract-msg の依存。本文と添付だけなら直接読む
+    with olefile.OleFileIO(BytesIO(src) if isinstance(src, bytes) else src) as ole:
+        def stream(name):
+            return ole.openstream(name).read() if ole.exists(name) else None
+
+        # 添付は埋め込みメッセージの中のものも含めて数える（ディレクトリを見るだけで中身は読まない）
+        _check_attachment_count(sum(1 for path in ole.listdir(streams=False, storages=True)
+                                    if path[-1].startswith(_MSG_ATTACH_PREFIX)))
+
+        # 文字列プロパティが UTF-16 かどうかはルートのプロパティストリームで決まる（ヘッダ 32 バイト + 16 バイト/件）
+        props = stream("__properties_version1.0") or b""
+        mask = 0
+        for off in range(32, len(props) - 15, 16):
+            tag, _, value = struct.unpack_from("<IIQ", props, off)
+            if tag == _MSG_STORE_SUPPORT_MASK:
+                mask = value
+                break
+        if not mask & _MSG_STORE_UNICODE_OK:
+            return None
+
+        has_rtf = ole.exists("__substg1.0_10090102")
+        body = stream("__substg1.0_1000001F")
+        if body is None and has_rtf:
+            return None
+        raw_text = to_str(body.decode("utf-16-le")) if body else ""
+        raw_html = b""
+        if not raw_text:
+            raw_html = stream("__substg1.0_10130102")
+            if raw_html is None:
+                if has_rtf:
+                    return None
+                raw_html = b""
+
+        found = []
+        if not _msg_storage_attachments(ole, stream, [], trail, found):
+            return None
+    return raw_text, raw_html, found
+
+def _msg_storage_attachments(ole, stream, base: List[str], trail: tuple, found: List[tuple]) -> bool:
+    # base のストレージ（ルートまたは埋め込みメッセージ）直下の添付を found に足す。
+    # 埋め込みメッセージは同じ OLE の中にあるので、MAIL_MAX_DEPTH まではそのまま降りる。
+    # extract-msg に任せるべき添付（OLE オブジェクトとして埋め込まれたもの）があれば False
+    for path in ole.listdir(streams=False, storages=True):
+        if len(path) != len(base) + 1 or path[:-1] != base or not path[-1].startswith(_MSG_ATTACH_PREFIX):
+            continue
+        d = "/".join(path) + "/"
+        name_b = stream(d + "__substg1.0_3707001F") or stream(d + "__substg1.0_3704001F")
+        name = name_b.decode("utf-16-le") if name_b else ""
+        if ole.exists(d + "__substg1.0_3701000D/__properties_version1.0"):
+            if len(trail) < MAIL_MAX_DEPTH and not _msg_storage_attachments(
+                    ole, stream, path + ["__substg1.0_3701000D"], trail + (name or "embedded.msg",), found):
+                return False
+            continue
+        name = name or "attachment"
+        excel = _is_excel_filename(name)
+        if not (excel or _is_container_filename(name)):
+            continue
+        if ole.exists(d + "__substg1.0_3701000D"):
+            return False
+        data = stream(d + "__substg1.0_37010102")
+        if data:
+            found.append((trail + (name,), data, excel))
+    return True
+
+def _read_msg_extract_msg(src, trail: tuple = ()):
+    import extract_msg  # pip install extract-msg
+    msg = extract_msg.Message(src)
+    try:
+        _check_attachment_count(len(msg.attachments))
+        raw_text = to_str(getattr(msg, "body", "") or "")
+        # HTML 本文はプレーンテキストが無いときだけ読む（extract-msg の属性名は htmlBody、値は bytes）
+        raw_html = b"" if raw_text else (getattr(msg, "htmlBody", None) or b"")
+
+        found = []
+        _msg_found_extract_msg(msg.attachments, trail, found)
+    finally:
+        msg.close()
+    return raw_text, raw_html, found
+
+def _msg_found_extract_msg(attachments, trail: tuple, found: List[tuple]) -> None:
+    for att in attachments:
+        name = getattr(att, "longFilename", "") or getattr(att, "shortFilename", "") or ""
         data = getattr(att, "data", None)
         if not data:
             continue
-        if _is_excel_filename(name):
-            try:
-                cells_text = _excel_sparse_from_bytes(data, filename=name)
-            except Exception as e:
-                cells_text = f"# ERROR: excel parse failed: {e}"
-            excel_results.append({"filename": name, "cells": cells_text})
+        if hasattr(data, "attachments"):
+            # 埋め込みメッセージは extract-msg が Message として返す
+            if len(trail) < MAIL_MAX_DEPTH:
+                _msg_found_extract_msg(data.attachments, trail + (name or "embedded.msg",), found)
+            continue
+        name = name or "attachment"
+        excel = _is_excel_filename(name)
+        if excel or _is_container_filename(name):
+            found.append((trail + (name,), data, excel))
+
+def _read_msg(src, trail: tuple = ()):
+    try:
+        read = _read_msg_direct(src, trail)
+    except (_BudgetExceeded, TimeoutError, MemoryError):
+        # 時間・メモリの上限はここで握りつぶさない（extract-msg で読み直すと上限を超えて続いてしまう）
+        raise
+    except Exception:
+        read = None
+    return read if read is not None else _read_msg_extract_msg(src, trail)
+
+def _msg_contents(b: bytes) -> tuple:
+    # (本文テキスト, 入れ子を開いた後の Excel 添付)。解析プールのワーカー内で実行される
+    # OLE はメモリ上から直接開く（mmap の場合は読み終わるまで開いたままにする）
+    with _spooled(b) as src:
+        with _stage("msg", "open"):
+            raw_text, raw_html, found = _read_msg(src)
+
+    if raw_text:
+        body_text = raw_text
+    else:
+        with _stage("msg", "html"):
+            if isinstance(raw_html, bytes):
+                raw_html = _decode_html_bytes(raw_html)
+            body_text = _html_to_text(raw_html, HTML_TEXT_MAX_CHARS)
+
+    with _stage("msg", "open"):
+        leaves = _expand_attachments(found)
+    return body_text, leaves
+
+def _handle_msg_bytes(b: bytes, typed: bool = False) -> Dict:
+    _observe_input("msg", len(b))
+    body_text, leaves = _run_parse(_msg_contents, b)
+    excel_results = _attachment_results(leaves, typed)
     return {"ok": True, "format": "msg", "body_text": body_text, "excel_attachments": excel_results}
 
-def _handle_eml_bytes(b: bytes) -> Dict:
-    msg = BytesParser(policy=policy.default).parsebytes(b)
+# .eml は一度だけ先頭から走査する。ヘッダだけを email パッケージで解釈し、本文はバイト位置で区切って持つ。
+# デコードするのは本文に使うパートと Excel 添付だけで、PDF や画像などの添付は読み飛ばす。
+
+_EML_HEADER_PARSER = BytesHeaderParser(policy=policy.default)
+_EML_MAX_DEPTH = 32  # multipart / message/rfc822 の入れ子の上限。超えた分は1つのパートとして扱う
+
+def _eml_split_header(buf: bytes, start: int, end: int) -> tuple:
+    # (ヘッダ終端, 本文開始) を返す。空行が無ければ全体をヘッダとみなす
+    if buf.startswith(b"\n", start, end):
+        return start, start + 1
+    if buf.startswith(b"\r\n", start, end):
+        return start, start + 2
+    lf = buf.find(b"\n\n", start, end)
+    crlf = buf.find(b"\n\r\n", start, end)
+    if lf < 0 and crlf < 0:
+        return end, end
+    if crlf < 0 or 0 <= lf < crlf:
+        return lf + 1, lf + 2
+    return crlf + 1, crlf + 3
+
+def _eml_split_parts(buf: bytes, start: int, end: int, boundary: bytes):
+    # multipart 本文を区切り行で分け、各パートの (開始, 終了) を返す。前文・後文は捨てる
+    delim = b"--" + boundary
+    part_start = None
+    pos = start
+    while True:
+        i = buf.find(delim, pos, end)
+        if i < 0:
+            break
+        pos = i + len(delim)
+        if i > start and buf[i - 1] != 0x0A:
+            continue
+        closing = buf.startswith(b"--", pos, end)
+        eol = buf.find(b"\n", pos, end)
+        line_end = end if eol < 0 else eol
+        if buf[pos + 2 if closing else pos:line_end].strip(b" \t\r"):
+            continue  # 境界文字列で始まるだけの行
+        if part_start is not None:
+            # 区切り行の直前の改行は区切りの一部
+            part_end = i - 1
+            if part_end > part_start and buf[part_end - 1] == 0x0D:
+                part_end -= 1
+            yield part_start, max(part_start, part_end)
+        if closing:
+            return
+        part_start = end if eol < 0 else eol + 1
+    if part_start is not None:
+        yield part_start, end
+
+def _eml_leaves(buf: bytes, start: int, end: int, default_type: str = "text/plain", depth: int = 0,
+                trail: tuple = ()):
+    # 末端のパートを (深さ, 入れ子の経路, ヘッダ, 本文開始, 本文終了) で出現順に返す（Message.walk() と同じ順序）。
+    # 経路には中に降りた message/rfc822 の名前が積まれる。エンコードされていない message/rfc822 は
+    # 従来どおり MAIL_MAX_DEPTH に関係なく中まで降りる（深さの上限は _EML_MAX_DEPTH だけ）
+    hdr_end, body_start = _eml_split_header(buf, start, end)
+    head = _EML_HEADER_PARSER.parsebytes(buf[start:hdr_end])
+    if default_type != "text/plain":
+        head.set_default_type(default_type)
+    ctype = head.get_content_type()
+    if depth < _EML_MAX_DEPTH:
+        if head.get_content_maintype() == "multipart":
+            boundary = head.get_boundary()
+            if boundary:
+                child_type = "message/rfc822" if ctype == "multipart/digest" else "text/plain"
+                for s, e in _eml_split_parts(buf, body_start, end, boundary.encode("ascii", "surrogateescape")):
+                    yield from _eml_leaves(buf, s, e, child_type, depth + 1, trail)
+                return
+        elif ctype == "message/rfc822" and _eml_cte(head) in ("", "7bit", "8bit", "binary"):
+            yield from _eml_leaves(buf, body_start, end, depth=depth + 1,
+                                   trail=trail + (head.get_filename() or "message.eml",))
+            return
+    yield depth, trail, head, body_start, end
+
+def _eml_cte(head) -> str:
+    return str(head.get("content-transfer-encoding", "")).strip().lower()
+
+def _eml_payload(buf: bytes, head, start: int, end: int) -> bytes:
+    # Message.get_payload(decode=True) 相当。必要なパートにだけ呼ぶ
+    raw = memoryview(buf)[start:end]
+    cte = _eml_cte(head)
+    if cte == "base64":
+        try:
+            return binascii.a2b_base64(raw)
+        except binascii.Error:
+            # パディング欠けは補って読み直す
+            packed = bytes(raw).translate(None, b" \t\r\n")
+            try:
+                return binascii.a2b_base64(packed + b"=" * (-len(packed) % 4))
+            except binascii.Error:
+                return b""
+    if cte == "quoted-printable":
+        return binascii.a2b_qp(raw)
+    return bytes(raw)
+
+def _eml_text(buf: bytes, head, start: int, end: int) -> str:
+    data = _eml_payload(buf, head, start, end)
+    try:
+        return data.decode(head.get_content_charset("ascii"), errors="replace")
+    except LookupError:
+        return data.decode("utf-8", errors="replace")
 
+def _read_eml(b: bytes, trail: tuple = ()) -> tuple:
+    # (本文テキスト, [HTML パートの位置], [(入れ子の経路, データ, Excel か)]) を返す
     body_text = ""
-    if msg.is_multipart():
-        for part in msg.walk():
-            if part.get_content_type() == "text/plain" and part.get_content_disposition() in (None, "inline"):
-                body_text = to_str(part.get_content())
-                if body_text:
-                    break
-        if not body_text:
-            for part in msg.walk():
-                if part.get_content_type() == "text/html" and part.get_content_disposition() in (None, "inline"):
-                    body_text = _html_to_text(part.get_content())
-                    if body_text:
+    html_parts = []
+    found = []
+    attachments = 0
+    # 本文は text/plain を優先し、無ければ text/html。HTML は位置だけ覚えておき、最後に必要なら変換する
+    for depth, inner, head, start, end in _eml_leaves(b, 0, len(b), trail=trail):
+        ctype = head.get_content_type()
+        cdisp = head.get_content_disposition()
+        if depth == 0 or cdisp in (None, "inline"):
+            if ctype == "text/plain" and not body_text:
+                body_text = to_str(_eml_text(b, head, start, end))
+            elif ctype == "text/html":
+                html_parts.append((head, start, end))
+        fname = head.get_filename()
+        if cdisp == "attachment" or fname or ctype == "message/rfc822":
+            attachments += 1
+            _check_attachment_count(attachments)
+            excel = _is_excel_filename(fname) or _is_excel_mime(ctype)
+            if excel or _is_container_filename(fname) or _is_container_mime(ctype):
+                data = _eml_payload(b, head, start, end)
+                if data:
+                    name = fname or ("attachment.xlsx" if excel else
+                                     "message.eml" if ctype == "message/rfc822" else "attachment")
+                    found.append((inner + (name,), data, excel))
+    return body_text, html_parts, found
+
+def _eml_contents(b: bytes) -> tuple:
+    # (本文テキスト, 入れ子を開いた後の Excel 添付)。解析プールのワーカー内で実行される
+    with _stage("eml", "open"):
+        body_text, html_parts, found = _read_eml(b)
+
+    if not body_text:
+        for head, start, end in html_parts:
+            with _stage("eml", "html"):
+                body_text = _html_to_text(_eml_text(b, head, start, end), HTML_TEXT_MAX_CHARS)
+            if body_text:
+                break
+
+    with _stage("eml", "open"):
+        leaves = _expand_attachments(found)
+    return body_text, leaves
+
+def _handle_eml_bytes(b: bytes, typed: bool = False) -> Dict:
+    _observe_input("eml", len(b))
+    body_text, leaves = _run_parse(_eml_contents, b)
+    excel_results = _attachment_results(leaves, typed)
+    return {"ok": True, "format": "eml", "body_text": body_text, "excel_attachments": excel_results}
+
+# 添付の中の添付（転送メールに付いた元メール、Outlook の埋め込みメッセージ、zip）も MAIL_MAX_DEPTH まで開く。
+# .eml にエンコードされずに入った message/rfc822 は以前から中まで読んでいたので、この上限に関係なく読む。
+# 経路は最上位の添付からの名前の並び（例: ["元メール.eml", "data.zip", "集計/売上.xlsx"]）で、結果の path に入る。
+# 同じ中身のブックは何か所に出てきても解析は1回で、出現ごとに同じ結果を返す。
+
+_CONTAINER_MIMES = ("message/rfc822", "application/zip", "application/x-zip-compressed", "application/vnd.ms-outlook")
+
+def _is_container_filename(name: str | None) -> bool:
+    return (name or "").lower().endswith((".zip", ".msg", ".eml"))
+
+def _is_container_mime(mime: str | None) -> bool:
+    return (mime or "").lower() in _CONTAINER_MIMES
+
+def _container_kind(data: bytes, excel: bool) -> str | None:
+    # 中身で判定する: "excel"（名前に関係なくブック）/ "zip" / "msg" / "eml" / None（対象外）
+    if excel:
+        return "excel"
+    kind = _sniff_format(data)
+    if kind == "zip":
+        try:
+            with zipfile.ZipFile(BytesIO(data)) as zf:
+                names = zf.namelist()
+        except zipfile.BadZipFile:
+            return "zip"  # 開くときのエラーとして返す
+        if "[Content_Types].xml" in names and any(n.startswith("xl/") for n in names):
+            return "excel"
+        return "zip"
+    if kind == "xls":
+        return "excel"
+    return kind if kind in ("msg", "eml") else None
+
+def _zip_attachments(data: bytes, trail: tuple) -> List[tuple]:
+    # メンバーは中央ディレクトリで選んで1つずつ展開する（アーカイブ全体は展開しない）
+    found = []
+    with zipfile.ZipFile(BytesIO(data)) as zf:
+        picked = [info for info in zf.infolist()
+                  if not info.is_dir() and not info.filename.startswith("__MACOSX/")
+                  and (_is_excel_filename(info.filename) or _is_container_filename(info.filename))]
+        _check_attachment_count(len(picked))
+        _check_zip_members(zf, picked)
+        for info in picked:
+            with zf.open(info) as fp:
+                found.append((trail + (info.filename,), fp.read(), _is_excel_filename(info.filename)))
+    return found
+
+def _expand_attachments(found: List[tuple]) -> List[tuple]:
+    # [(経路, データ, Excel か)] → 入れ子を開いた後の Excel 添付 [(経路, データ, エラー)] を出現順に返す
+    out = []
+    stack = found[::-1]
+    opened = 0
+    while stack:
+        path, data, excel = stack.pop()
+        kind = _container_kind(data, excel)
+        if kind == "excel":
+            out.append((path, data, None))
+            continue
+        if kind is None or len(path) > MAIL_MAX_DEPTH:
+            continue
+        try:
+            if kind == "zip":
+                children = _zip_attachments(data, path)
+            elif kind == "msg":
+                children = _read_msg(data, path)[2]
+            else:
+                children = _read_eml(data, path)[2]
+        except (_BudgetExceeded, TimeoutError, MemoryError):
+            raise
+        except Exception as e:
+            out.append((path, None, f"# ERROR: failed to open nested {kind}: {e}"))
+            continue
+        opened += len(children)
+        _check_attachment_count(len(found) + opened)
+        stack.extend(children[::-1])
+    return out
+
+def _attachment_results(leaves: List[tuple], typed: bool) -> List[Dict]:
+    # leaves は _expand_attachments の結果
+    items, slots, seen = [], [], {}
+    for path, data, error in leaves:
+        if error is not None:
+            slots.append(error)
+            continue
+        digest = hashlib.sha256(data).digest()
+        if digest not in seen:
+            seen[digest] = len(items)
+            items.append((path[-1], data))
+        slots.append(seen[digest])
+    results = _extract_attachments(items, typed) if items else []
+    return [_attachment_result(path, results[slot] if isinstance(slot, int) else slot, typed)
+            for (path, _, _), slot in zip(leaves, slots)]
+
+# ========= 解析プロセスプール / 添付Excelの並列抽出 =========
+# ブックの解析は CPU バウンドなのでプロセスプールに投げる。添付の結果は添付順のまま返し、
+# 時間切れの添付は # ERROR: 行に置き換えてリクエスト全体を止めない。
+# 時間切れはワーカー側で SIGALRM により打ち切るので、プールを壊さずに次の解析へ進める。
+# 時間はワーカーがタスクに取りかかった時点から数える（他のリクエストのタスクの後ろで待っている間は数えない）。
+# 各ワーカーは共有配列の自分の枠に (タスク番号, 開始時刻) を書き、親はそれを見て打ち切りの要否を決める。
+# 1つのリクエストが同時に投げるタスクはプールの大きさまで（残りは手元で待たせる）。
+# ジョブの処理スレッドからの解析は別のプール（JOB_WORKERS 個）に投げ、同期リクエスト用のワーカーを空けておく。
+
+_parse_pools: Dict[str, ProcessPoolExecutor] = {}  # "parse"（同期リクエスト）/ "jobs"
+_parse_pool_lock = threading.Lock()
+_BUDGET_GRACE = 5.0  # ワーカー側の打ち切りが効かなかった場合に親が待つ猶予（秒）
+_POOL_POLL = 0.5     # 取りかかったタスクの経過時間を確かめる間隔（秒）
+_pool_task_ids = itertools.count(1)
+_worker_slot = None  # ワーカー内: (共有配列, 自分の枠の位置)
+
+def _parse_pool_key() -> str:
+    return "jobs" if getattr(_job_local, "job", None) is not None else "parse"
+
+def _parse_pool_workers() -> int:
+    # このスレッドが使うプールの大きさ（0 ならこのスレッドで解析する）
+    if PARSE_POOL_WORKERS <= 0:
+        return 0
+    return JOB_WORKERS if _parse_pool_key() == "jobs" else PARSE_POOL_WORKERS
+
+def _get_parse_pool() -> ProcessPoolExecutor:
+    key = _parse_pool_key()
+    with _parse_pool_lock:
+        pool = _parse_pools.get(key)
+        if pool is None or pool._broken:
+            # スレッドを抱えた親から fork しないよう forkserver / spawn を使う
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            ctx = multiprocessing.get_context(method)
+            if method == "forkserver":
+                # forkserver に解析ライブラリまで読み込ませておき、ワーカーはそこから fork して import を省く
+                ctx.set_forkserver_preload([m for m in (__name__,) if m != "__main__"] + list(_BACKEND_MODULES))
+            workers = _parse_pool_workers()
+            started = ctx.Array("d", 2 * workers, lock=False)  # ワーカーごとに (タスク番号, 開始時刻)
+            claimed = ctx.Value("i", 0)
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                       initializer=_init_parse_worker, initargs=(started, claimed))
+            pool.started = started
+            _parse_pools[key] = pool
+        return pool
+
+def _init_parse_worker(started=None, claimed=None) -> None:
+    global _worker_slot
+    if started is not None:
+        with claimed.get_lock():
+            slot = claimed.value
+            claimed.value += 1
+        if slot < len(started) // 2:
+            _worker_slot = (started, slot)
+    # ワーカーのアドレス空間に上限を掛け、超える確保は MemoryError にしてプロセスごと落ちないようにする
+    if PARSE_MAX_MEMORY <= 0:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = PARSE_MAX_MEMORY if hard == resource.RLIM_INFINITY else min(PARSE_MAX_MEMORY, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+def _abandon_parse_pool(pool: ProcessPoolExecutor) -> None:
+    # 打ち切りに応じないワーカーが居座った場合だけ（猶予を過ぎた後に呼ばれる）、そのプールを手放して次回作り直す。
+    # SIGALRM の効かない C の処理で止まったワーカーは shutdown では終わらないので、プロセスごと止める。
+    # 同じプールで実行中だった他のタスクは BrokenProcessPool になり、_pool_map が新しいプールで1回だけ再投入する。
+    # future は取り消さない（管理スレッドが BrokenProcessPool を設定するときに InvalidStateError になるため）
+    with _parse_pool_lock:
+        key = next((k for k, p in _parse_pools.items() if p is pool), None)
+        if key is None:
+            return
+        del _parse_pools[key]
+    procs = list((pool._processes or {}).values())
+    pool.shutdown(wait=False)
+    for proc in procs:
+        proc.terminate()
+
+def _on_budget_expired(signum, frame):
+    raise TimeoutError("time budget exceeded")
+
+def _budgeted(budget: float, fn, *args):
+    # プールのワーカー内で実行される。budget 秒を超えたら TimeoutError で打ち切る
+    if budget <= 0 or threading.current_thread() is not threading.main_thread():
+        return fn(*args)
+    prev = signal.signal(signal.SIGALRM, _on_budget_expired)
+    signal.setitimer(signal.ITIMER_REAL, budget)
+    try:
+        return fn(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, prev)
+
+def _pool_task(task_id: int, budget: float, deadline: float, fn, *args):
+    # プールのワーカー内で実行される。結果と、そこで測ったステージ別の時間を組にして返す。
+    # deadline は依頼元のリクエストの締め切り（time.monotonic はプロセス間で共通）で、budget をその残りまでに縮める
+    now = time.monotonic()
+    if _worker_slot is not None:
+        started, slot = _worker_slot
+        started[2 * slot + 1] = now  # 親はタスク番号を見てから時刻を読むので、時刻を先に書く
+        started[2 * slot] = task_id
+    if deadline:
+        if now >= deadline:
+            raise TimeoutError("time budget exceeded")
+        budget = min(budget, deadline - now) if budget > 0 else deadline - now
+    with _timing_scope() as stages:
+        try:
+            result = _budgeted(budget, fn, *args)
+        except MemoryError:
+            raise _BudgetExceeded(f"memory budget exceeded ({PARSE_MAX_MEMORY} bytes)") from None
+    return result, stages
+
+def _pool_submit(pool: ProcessPoolExecutor, budget: float, fn, *args) -> tuple:
+    task_id = next(_pool_task_ids)
+    return pool.submit(_pool_task, task_id, budget, _deadline(), fn, *args), task_id
+
+def _pool_begun(pool: ProcessPoolExecutor) -> Dict[int, float]:
+    # {タスク番号: ワーカーが取りかかった時刻}（いま実行中のタスクだけ）
+    started = list(getattr(pool, "started", ()))
+    return {int(started[i]): started[i + 1] for i in range(0, len(started), 2) if started[i]}
+
+def _pool_overdue(t0: float, budget: float, deadline: float, now: float) -> bool:
+    # t0 に取りかかったタスクが、ワーカー側の打ち切り（budget か締め切りの早い方）+ 猶予を過ぎても終わっていないか
+    ends = ([t0 + budget] if budget > 0 else []) + ([deadline] if deadline else [])
+    return bool(ends) and now > min(ends) + _BUDGET_GRACE
+
+def _pool_map(calls: List[tuple], budget: float):
+    # calls: [(key, fn, args), ...]。終わった順に (key, 結果, 例外) を返す（成功なら例外は None）。
+    # 同時にプールへ投げるのはプールの大きさまでにして、大きなバッチが他のリクエストの解析を待たせないようにする。
+    # ワーカーが取りかかってから budget（か締め切り）+ 猶予を過ぎても終わらないタスクは TimeoutError として返し、
+    # その時点でプールを手放す。巻き添えで BrokenProcessPool になったタスクは新しいプールで1回だけ再投入する。
+    # 締め切りを過ぎたら、まだ投げていないタスクは投げずに、取りかかられていないタスクは待たずに TimeoutError とする
+    todo = [(key, fn, args, 0) for key, fn, args in reversed(calls)]
+    running = {}  # future -> (key, fn, args, 試行回数, プール, タスク番号)
+    limit = max(_parse_pool_workers(), 1)
+    deadline = _deadline()
+    while todo or running:
+        while todo and len(running) < limit:
+            key, fn, args, attempt = todo.pop()
+            if deadline and time.monotonic() >= deadline:
+                yield key, None, TimeoutError("time budget exceeded")
+                continue
+            pool = _get_parse_pool()
+            fut, task_id = _pool_submit(pool, budget, fn, *args)
+            running[fut] = (key, fn, args, attempt, pool, task_id)
+        done, _ = wait(running, timeout=_POOL_POLL, return_when=FIRST_COMPLETED)
+        for fut in done:
+            key, fn, args, attempt, _, _ = running.pop(fut)
+            try:
+                result, stages = fut.result()
+            except BrokenProcessPool as e:
+                if attempt == 0:
+                    todo.append((key, fn, args, 1))
+                else:
+                    yield key, None, e
+                continue
+            except Exception as e:
+                yield key, None, e
+                continue
+            _timing_merge(stages)
+            yield key, result, None
+        if (budget <= 0 and not deadline) or not running:
+            continue
+        begun = {}
+        now = time.monotonic()
+        for fut, (key, _, _, _, pool, task_id) in list(running.items()):
+            if id(pool) not in begun:
+                begun[id(pool)] = _pool_begun(pool)
+            t0 = begun[id(pool)].get(task_id)
+            if fut.done():
+                continue
+            if t0 is None:
+                # まだどのワーカーも取りかかっていない。締め切りを過ぎたら待たない（後で取りかかってもすぐ終わる）
+                if deadline and now > deadline + _BUDGET_GRACE:
+                    fut.cancel()
+                    del running[fut]
+                    yield key, None, TimeoutError("time budget exceeded")
+                continue
+            if _pool_overdue(t0, budget, deadline, now):
+                del running[fut]
+                _abandon_parse_pool(pool)
+                yield key, None, TimeoutError("time budget exceeded")
+
+def _run_parse(fn, *args):
+    # 解析をプロセスプールで実行して待つ（プール無効時はこのスレッドで実行）。PARSE_TIMEOUT を超えたら打ち切る
+    if _parse_pool_workers() <= 0:
+        return fn(*args)
+    budget = _job_budget(PARSE_TIMEOUT)
+    for _, result, error in _pool_map([(None, fn, args)], budget):
+        if isinstance(error, TimeoutError):
+            raise _BudgetExceeded(_timeout_reason(f"parse time budget exceeded ({budget:g}s)")) from None
+        if error is not None:
+            raise error
+        return result
+
+def _pool_stream(conn, fn, *args):
+    # プールのワーカー内で実行される。fn(*args) の返す要素を1つずつ conn に送る
+    try:
+        for item in fn(*args):
+            conn.send(item)
+    finally:
+        conn.close()
+
+def _iter_pooled(fn, *args):
+    # fn(*args)（ジェネレーター）をプールのワーカーで回し、できた要素からパイプで受け取って返す（ストリーミング応答用）。
+    # 時間の上限は _run_parse と同じで、クライアントへの送信が詰まってワーカーが待たされている間も数える。
+    # 何も返さないうちにプールが壊れた場合だけ、新しいプールで1回再投入する
+    budget = _job_budget(PARSE_TIMEOUT)
+    deadline = _deadline()
+    for attempt in range(2):
+        pool = _get_parse_pool()
+        recv, send = multiprocessing.Pipe(duplex=False)
+        fut, task_id = _pool_submit(pool, budget, _pool_stream, send, fn, *args)
+        fut.add_done_callback(lambda _, send=send: send.close())  # ワーカーに渡し終えるまで親の側も閉じない
+        received = False
+        try:
+            while True:
+                if recv.poll(_POOL_POLL):
+                    try:
+                        item = recv.recv()
+                    except EOFError:
                         break
-    else:
-        ctype = msg.get_content_type()
-        if ctype == "text/plain":
-            body_text = to_str(msg.get_content())
-        elif ctype == "text/html":
-            body_text = _html_to_text(msg.get_content())
-
-    excel_results: List[Dict] = []
-    for part in msg.walk():
-        fname = part.get_filename()
-        cdisp = part.get_content_disposition()
-        ctype = part.get_content_type()
-        if cdisp == "attachment" or fname:
-            if _is_excel_filename(fname) or _is_excel_mime(ctype):
-                data = part.get_payload(decode=True) or b""
-                if not data:
+                    received = True
+                    yield item
                     continue
-                try:
-                    cells_text = _excel_sparse_from_bytes(data, filename=fname or "")
-                except Exception as e:
-                    cells_text = f"# ERROR: excel parse failed: {e}"
-                excel_results.append({"filename": fname or "attachment.xlsx", "cells": cells_text})
+                if fut.done() and not recv.poll(0):
+                    break  # 終わった時点で送られた分はパイプに入っているので、空なら読み切っている
+                t0 = _pool_begun(pool).get(task_id)
+                if t0 is not None and _pool_overdue(t0, budget, deadline, time.monotonic()):
+                    _abandon_parse_pool(pool)
+                    raise _BudgetExceeded(_timeout_reason(f"parse time budget exceeded ({budget:g}s)"))
+        finally:
+            recv.close()  # 途中で読むのをやめた場合、ワーカーは送信で BrokenPipeError になって止まる
+        try:
+            _, stages = fut.result()
+        except BrokenProcessPool:
+            if attempt or received:
+                raise
+            continue
+        except TimeoutError:
+            raise _BudgetExceeded(_timeout_reason(f"parse time budget exceeded ({budget:g}s)")) from None
+        _timing_merge(stages)
+        return
+
+def _extract_attachments(items: List[tuple], typed: bool = False) -> List:
+    # items: [(filename, data), ...] → 添付順のセルTSV。typed なら列指向の dict（失敗した添付は # ERROR: の文字列）
+    results: List[str | None] = [None] * len(items)
+    keys = []
+    todo = []
+    parse = _excel_cells_uncached if typed else _excel_sparse_uncached
+    budget = _job_budget(ATTACHMENT_TIMEOUT)
+    _job_progress(attachments_total=len(items))
+    for i, (name, data) in enumerate(items):
+        _observe_input(_excel_format(name, data), len(data))
+        key = _excel_sparse_key(data, filename=name, typed=typed)
+        keys.append(key)
+        cached = _extract_cache.get(key)
+        if cached is not None:
+            results[i] = cached
+            _job_progress(attachments_done=1)
+        else:
+            todo.append(i)
 
-    return {"ok": True, "format": "eml", "body_text": body_text, "excel_attachments": excel_results}
+    if todo and _parse_pool_workers() <= 0:
+        for i in todo:
+            name, data = items[i]
+            try:
+                results[i] = parse(data, filename=name)
+                _extract_cache.put(keys[i], results[i])
+            except Exception as e:
+                results[i] = f"# ERROR: excel parse failed: {e}"
+            _job_progress(attachments_done=1)
+        return _observe_attachment_cells(items, results, typed)
+
+    for i, result, error in _pool_map([(i, parse, (items[i][1], items[i][0])) for i in todo], budget):
+        if error is None:
+            results[i] = result
+            _extract_cache.put(keys[i], result)
+        elif isinstance(error, TimeoutError):
+            results[i] = "# ERROR: " + _timeout_reason(f"excel parse timed out after {budget:g}s")
+        else:
+            results[i] = f"# ERROR: excel parse failed: {error}"
+        _job_progress(attachments_done=1)
+    return _observe_attachment_cells(items, results, typed)
+
+def _observe_attachment_cells(items: List[tuple], results: List[str], typed: bool = False) -> List:
+    out = []
+    for (name, data), text in zip(items, results):
+        if text.startswith("# ERROR:"):
+            out.append(text)
+        elif typed:
+            doc = json.loads(text)
+            _observe_doc(_excel_format(name, data), doc)
+            out.append(doc)
+        else:
+            _observe_cells(_excel_format(name, data), text.split("\n"))
+            out.append(text)
+    return out
+
+def _attachment_result(path: tuple, cells, typed: bool) -> Dict:
+    # TSV は失敗も # ERROR: 行として cells に入れる（従来どおり）。列指向では error に分ける
+    head = {"filename": path[-1], "path": list(path)}
+    if typed and isinstance(cells, str):
+        return {**head, "error": cells[len("# ERROR: "):]}
+    return {**head, "cells": cells}
+
+def _iter_extract_batch(items: List[tuple], sheet_req: str | None = None):
+    # items: [(filename, data), ...] → 終わった順に (index, TSV or 例外) を返す
+    pending = []
+    for i, (name, data) in enumerate(items):
+        if not data:
+            yield i, ValueError("empty file")
+            continue
+        cached = _extract_cache.get(_excel_sparse_key(data, name, sheet_req))
+        if cached is not None:
+            yield i, cached
+        else:
+            pending.append(i)
+
+    if _parse_pool_workers() <= 0:
+        for i in pending:
+            name, data = items[i]
+            try:
+                yield i, _excel_sparse_from_bytes(data, filename=name, sheet_req=sheet_req)
+            except Exception as e:
+                yield i, e
+        return
+
+    calls = [(i, _excel_sparse_uncached, (items[i][1], items[i][0], sheet_req)) for i in pending]
+    for i, result, error in _pool_map(calls, ATTACHMENT_TIMEOUT):
+        if isinstance(error, TimeoutError):
+            yield i, TimeoutError(_timeout_reason(f"timed out after {ATTACHMENT_TIMEOUT:g}s"))
+            continue
+        if error is not None:
+            yield i, error
+            continue
+        _observe_cells(_excel_format(*items[i]), result.split("\n"))
+        _extract_cache.put(_excel_sparse_key(items[i][1], items[i][0], sheet_req), result)
+        yield i, result
+
+if PRELOAD_BACKENDS:
+    warm_up()
 
 # ========= main =========
 
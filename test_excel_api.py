@@ -0,0 +1,346 @@
+"""
+excel_api の出力の一致を確かめる回帰テスト（python -m pytest -q）
+
+入力は bench_excel_api.build_corpus() の合成コーパス。解析は既定ではプロセスプールを使わずこのプロセスで行い、
+キャッシュは無効にして毎回解析させる。プールと資源の上限の試験だけは実際のプールを立てる。
+"""
+import io
+import os
+import re
+
+os.environ.update({"PARSE_POOL_WORKERS": "0", "EXTRACT_CACHE_BYTES": "0", "EXTRACT_CACHE_DIR": "",
+                   "JOB_WORKERS": "0", "ADMIT_MAX_ACTIVE": "64", "ADMIT_MAX_QUEUE": "64"})
+
+import pytest
+
+import bench_excel_api
+import excel_api
+
+CORPUS = bench_excel_api.build_corpus(0)
+BOOKS = sorted(k for k in CORPUS if k.startswith(("xlsx_", "xls_")))
+
+_COORD = re.compile(r"^([A-Z]+)(\d+)\t")
+
+@pytest.fixture(scope="module")
+def client():
+    return excel_api.app.test_client()
+
+def _col_num(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n
+
+# ========= /workbooks セッション =========
+
+def _extract_from_session(sheets):
+    # sheets: [(シート名, セッションから取ったシート全体の行)] → /extract sheets=all と同じ上限で切り詰めた出力
+    out, total = [], 0
+    for name, lines in sheets:
+        out.append(f"# sheet: {name}")
+        limit = min(excel_api.MAX_NONEMPTY_PER_SHEET, excel_api.MAX_NONEMPTY - total)
+        cells = []
+        for line in lines:
+            m = _COORD.match(line)
+            if m and int(m.group(2)) <= excel_api.MAX_ROWS and _col_num(m.group(1)) <= excel_api.MAX_COLS:
+                cells.append(line)
+        out += cells[:limit]
+        total += min(len(cells), limit)
+        if len(cells) >= limit:
+            out.append("# ...truncated...")
+        if total >= excel_api.MAX_NONEMPTY:
+            break
+    return "\n".join(out)
+
+@pytest.mark.parametrize("name", BOOKS)
+def test_session_cells_match_extract(client, name):
+    filename, data = CORPUS[name]
+    extracted = client.post("/extract", data={"file": (io.BytesIO(data), filename), "sheets": "all", "bom": "false"})
+    assert extracted.status_code == 200
+
+    created = client.post("/workbooks", data={"file": (io.BytesIO(data), filename)})
+    assert created.status_code == 201
+    info = created.get_json()
+    sheets = []
+    for sheet in info["sheets"]:
+        r = client.get(f"/workbooks/{info['id']}/cells", query_string={"sheet": sheet["name"], "bom": "false"})
+        assert r.status_code == 200
+        sheets.append((sheet["name"], r.get_data(as_text=True).split("\n")))
+    client.delete(f"/workbooks/{info['id']}")
+
+    assert _extract_from_session(sheets) == extracted.get_data(as_text=True)
+
+def test_session_defaults_to_active_sheet(client):
+    from openpyxl import Workbook
+    wb = Workbook()
+    wb.active["A1"] = "先頭"
+    wb.create_sheet("2枚目")["B2"] = "アクティブ"
+    wb.active = 1
+    buf = io.BytesIO()
+    wb.save(buf)
+    extracted = client.post("/extract", data={"file": (io.BytesIO(buf.getvalue()), "a.xlsx"), "bom": "false"})
+
+    created = client.post("/workbooks", data={"file": (io.BytesIO(buf.getvalue()), "a.xlsx")}).get_json()
+    assert created["active_sheet"] == "2枚目"
+    r = client.get(f"/workbooks/{created['id']}/cells", query_string={"bom": "false"})
+    client.delete(f"/workbooks/{created['id']}")
+    assert r.get_data(as_text=True) == extracted.get_data(as_text=True) == "B2\tアクティブ"
+
+# ========= xlsx のストリーミング読み（openpyxl と同じ出力） =========
+
+def _edge_xlsx(epoch_1904: bool = False) -> bytes:
+    # 値の変換で差が出やすいセル（日付書式、時刻、真偽値、エラー、リッチテキスト、改行・タブ入り文字列）
+    import datetime
+    from openpyxl import Workbook
+    from openpyxl.cell.rich_text import CellRichText, TextBlock
+    from openpyxl.cell.text import InlineFont
+    wb = Workbook()
+    if epoch_1904:
+        from openpyxl.utils.datetime import CALENDAR_MAC_1904
+        wb.epoch = CALENDAR_MAC_1904
+    ws = wb.active
+    ws.title = "型"
+    ws["A1"] = datetime.datetime(2024, 2, 29, 13, 45, 30)
+    ws["B1"] = datetime.date(1900, 3, 1)
+    ws["C1"] = datetime.time(7, 5)
+    ws["D1"] = 45000
+    ws["D1"].number_format = "yyyy/mm/dd"
+    ws["E1"] = 0.1 + 0.2
+    ws["F1"] = 10 ** 20
+    ws["A2"] = True
+    ws["B2"] = False
+    ws["C2"] = "#DIV/0!"
+    ws["D2"] = " 前後に空白 \t タブ\r\n改行_x000D_ "
+    ws["E2"] = CellRichText([TextBlock(InlineFont(b=True), "太字"), "と普通"])
+    ws["F2"] = "=1+1"
+    ws["AX200"] = "右下"
+    ws["AY201"] = "範囲外"
+    other = wb.create_sheet("2枚目")
+    other["C3"] = "x"
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+XLSX_BOOKS = {name: CORPUS[name][1] for name in BOOKS if name.startswith("xlsx_")}
+XLSX_BOOKS["edge"] = _edge_xlsx()
+XLSX_BOOKS["edge_1904"] = _edge_xlsx(epoch_1904=True)
+
+@pytest.mark.parametrize("typed", [False, True])
+@pytest.mark.parametrize("name", sorted(XLSX_BOOKS))
+def test_xlsx_streaming_matches_openpyxl(name, typed):
+    data = XLSX_BOOKS[name]
+    assert (list(excel_api._iter_xlsx_stream_rows(data, typed=typed))
+            == list(excel_api._iter_xlsx_openpyxl_rows(data, typed=typed)))
+    assert (list(excel_api._iter_xlsx_stream_multi_rows(data, "all", typed=typed))
+            == list(excel_api._iter_xlsx_openpyxl_multi_rows(data, "all", typed=typed)))
+
+def test_xlsx_streaming_stops_at_cell_limits():
+    data = XLSX_BOOKS["xlsx_dense"]
+    for limits in ((200, 50, 7), (3, 2, 2000), (200, 50, 1)):
+        assert (list(excel_api._iter_xlsx_stream_rows(data, None, *limits))
+                == list(excel_api._iter_xlsx_openpyxl_rows(data, None, *limits)))
+
+# ========= .eml の一回走査（email パッケージで全体を読んだ場合と同じ結果） =========
+
+def _eml_reference(raw: bytes) -> tuple:
+    # 一回走査にする前の読み方: BytesParser で全体を読み、walk() で本文と Excel 添付を拾う
+    from email import policy
+    from email.parser import BytesParser
+    msg = BytesParser(policy=policy.default).parsebytes(raw)
+    body_text = ""
+    if msg.is_multipart():
+        for part in msg.walk():
+            if part.get_content_type() == "text/plain" and part.get_content_disposition() in (None, "inline"):
+                body_text = excel_api.to_str(part.get_content())
+                if body_text:
+                    break
+        if not body_text:
+            for part in msg.walk():
+                if part.get_content_type() == "text/html" and part.get_content_disposition() in (None, "inline"):
+                    body_text = excel_api._html_to_text(part.get_content(), excel_api.HTML_TEXT_MAX_CHARS)
+                    if body_text:
+                        break
+    elif msg.get_content_type() == "text/plain":
+        body_text = excel_api.to_str(msg.get_content())
+    elif msg.get_content_type() == "text/html":
+        body_text = excel_api._html_to_text(msg.get_content(), excel_api.HTML_TEXT_MAX_CHARS)
+    found = []
+    for part in msg.walk():
+        fname = part.get_filename()
+        if part.get_content_disposition() == "attachment" or fname:
+            if excel_api._is_excel_filename(fname) or excel_api._is_excel_mime(part.get_content_type()):
+                data = part.get_payload(decode=True)
+                if data:
+                    found.append((fname or "attachment.xlsx", data))
+    return body_text, found
+
+def _eml_samples() -> dict:
+    from email import encoders
+    from email.message import EmailMessage
+    from email.mime.base import MIMEBase
+    from email.mime.message import MIMEMessage
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    xlsx = CORPUS["xlsx_skill"][1]
+
+    def attachment(data, name, ctype=("application", "vnd.openxmlformats-officedocument.spreadsheetml.sheet")):
+        part = MIMEBase(*ctype)
+        part.set_payload(data)
+        encoders.encode_base64(part)
+        part.add_header("Content-Disposition", "attachment", filename=name)
+        return part
+
+    samples = {name: data for name, (_, data) in CORPUS.items() if name.startswith("eml_")}
+
+    # 本文が空の text/plain と HTML の alternative、転送された元メール（message/rfc822）、PDF、日本語名の添付
+    m = MIMEMultipart("mixed")
+    alt = MIMEMultipart("alternative")
+    alt.attach(MIMEText("", "plain", "utf-8"))
+    alt.attach(MIMEText("<p>HTML本文</p><br>x", "html", "utf-8"))
+    m.attach(alt)
+    inner = EmailMessage()
+    inner["Subject"] = "fw"
+    inner.set_content("inner plain")
+    inner.add_attachment(xlsx, maintype="application", subtype="octet-stream", filename="inner.xlsx")
+    m.attach(MIMEMessage(inner))
+    m.attach(attachment(b"%PDF" + bytes(range(256)) * 400, "scan.pdf", ("application", "pdf")))
+    m.attach(attachment(xlsx, "表.xlsx"))
+    nested = m.as_bytes()
+    samples["nested"] = nested
+    samples["nested_crlf"] = nested.replace(b"\n", b"\r\n")
+    samples["no_close"] = nested.rsplit(b"--" + m.get_boundary().encode() + b"--", 1)[0]
+    samples["bad_pad"] = re.sub(rb"([A-Za-z0-9+/])=+\n(?=\n?--)", rb"\1\n", nested)  # base64 のパディング欠け
+
+    q = MIMEText("", "plain", "utf-8")
+    q.replace_header("Content-Transfer-Encoding", "quoted-printable")
+    q.set_payload(__import__("quopri").encodestring("quoted = printable テキスト\n".encode("utf-8") * 3).decode())
+    samples["qp"] = q.as_bytes()
+    samples["single_html"] = MIMEText("<b>only</b> html &amp; x", "html", "utf-8").as_bytes()
+
+    digest = MIMEMultipart("digest")
+    digest.attach(MIMEMessage(inner))
+    outer = MIMEMultipart("mixed")
+    outer.attach(MIMEText("digest body", "plain", "utf-8"))
+    outer.attach(digest)
+    samples["digest"] = outer.as_bytes()
+
+    rfc2231 = EmailMessage()
+    rfc2231.set_content("x")
+    rfc2231.add_attachment(xlsx, maintype="application", subtype="octet-stream", filename=("utf-8", "", "見積 書.xlsx"))
+    samples["rfc2231"] = rfc2231.as_bytes()
+    return samples
+
+EML_SAMPLES = _eml_samples()
+
+@pytest.mark.parametrize("name", sorted(EML_SAMPLES))
+def test_eml_one_pass_matches_email_package(name):
+    raw = EML_SAMPLES[name]
+    body_text, leaves = excel_api._eml_contents(raw)
+    assert (body_text, [(path[-1], data) for path, data, _ in leaves]) == _eml_reference(raw)
+
+@pytest.mark.parametrize("html_s, text", [
+    ("<p>官公庁向け</p><p>レビュー</p>", "官公庁向け レビュー"),
+    ("<div>x</div>\n<div>y</div>", "x y"),
+    ("a<br>b<br/>\r\nc", "a b c"),
+    ("<table><tr><td>1</td><td>2</td></tr></table>", "1 2"),
+    ("<p class=x>p</p ><style>s{}</style>&amp;z", "p &z"),
+])
+def test_html_to_text_separates_blocks_with_one_space(html_s, text):
+    assert excel_api._html_to_text(html_s) == text
+
+# ========= .msg の直接読み（extract-msg と同じ結果） =========
+
+def _msg_samples() -> dict:
+    import random
+    rng = random.Random(0)
+    xlsx = CORPUS["xlsx_skill"][1]
+    samples = {name: data for name, (_, data) in CORPUS.items() if name.startswith("msg_")}
+    samples["html_only_pdf"] = bench_excel_api._msg(rng, [("a.xlsx", xlsx), ("b.pdf", b"%PDF" * 1500)], html_only=True)
+    samples["empty_attachment"] = bench_excel_api._msg(rng, [("a.xlsx", b""), ("c.XLSX", xlsx)])
+    samples["zip_attachment"] = bench_excel_api._msg(rng, [("data.zip", CORPUS["xlsx_sparse"][1]), ("d.xls", xlsx)])
+    return samples
+
+MSG_SAMPLES = _msg_samples()
+
+@pytest.mark.parametrize("name", sorted(MSG_SAMPLES))
+def test_msg_direct_read_matches_extract_msg(name):
+    raw = MSG_SAMPLES[name]
+    direct = excel_api._read_msg_direct(raw)
+    assert direct is not None  # extract-msg に任せるケースではない
+    assert direct == excel_api._read_msg_extract_msg(raw)
+
+# ========= 解析プールと資源の上限 =========
+
+@pytest.fixture
+def parse_pool(monkeypatch):
+    # 既定の設定（PARSE_POOL_WORKERS > 0）と同じく、解析を実際のプロセスプールに投げる
+    monkeypatch.setattr(excel_api, "PARSE_POOL_WORKERS", 2)
+    yield
+    for pool in excel_api._parse_pools.values():
+        pool.shutdown(cancel_futures=True)
+    excel_api._parse_pools.clear()
+
+def test_pool_output_matches_in_process(client, parse_pool):
+    filename, data = CORPUS["xlsx_dense"]
+    form = lambda **kw: {"file": (io.BytesIO(data), filename), "sheets": "all", **kw}
+    excel_api.PARSE_POOL_WORKERS = 0
+    expected = client.post("/extract", data=form()).data
+    excel_api.PARSE_POOL_WORKERS = 2
+    assert client.post("/extract", data=form()).data == expected
+    with client.post("/extract", data=form(stream="true")) as r:
+        chunks = list(r.response)
+    assert len(chunks) > 1  # ワーカーで読んだ行から順に送る
+    assert b"".join(c if isinstance(c, bytes) else c.encode() for c in chunks) == expected
+    assert excel_api._parse_pools
+
+@pytest.mark.parametrize("stream", ["false", "true"])
+def test_pool_parse_timeout_is_413(client, parse_pool, monkeypatch, stream):
+    monkeypatch.setattr(excel_api, "PARSE_TIMEOUT", 0.001)
+    filename, data = CORPUS["xlsx_dense"]
+    r = client.post("/extract", data={"file": (io.BytesIO(data), filename), "sheets": "all", "stream": stream})
+    assert r.status_code == 413
+    assert "parse time budget exceeded" in r.get_json()["error"]
+
+def _zip(members: dict) -> bytes:
+    import zipfile
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+def test_zip_bomb_batch_is_rejected_before_reading(client, monkeypatch):
+    # 1MB 未満のメンバーは圧縮率を問わないので、合計の上限で止める
+    monkeypatch.setattr(excel_api, "ZIP_MAX_TOTAL_BYTES", 4 * 1024 * 1024)
+    bomb = _zip({f"{i}.xlsx": bytes(1024 * 1024 - 1) for i in range(8)})
+    r = client.post("/extract_batch", data={"file": (io.BytesIO(bomb), "bomb.zip")})
+    assert r.status_code == 413
+    assert "in total" in r.get_json()["error"]
+
+def test_zip_bomb_workbook_is_rejected(client):
+    bomb = _zip({"[Content_Types].xml": "<Types/>", "xl/worksheets/sheet1.xml": bytes(8 * 1024 * 1024)})
+    r = client.post("/extract", data={"file": (io.BytesIO(bomb), "bomb.xlsx")})
+    assert r.status_code == 413
+    assert "compression ratio" in r.get_json()["error"]
+
+@pytest.mark.parametrize("name", ["eml_3att", "msg_3att"])
+def test_mail_attachment_limit_is_413(client, monkeypatch, name):
+    monkeypatch.setattr(excel_api, "MAIL_MAX_ATTACHMENTS", 2)
+    filename, data = CORPUS[name]
+    r = client.post("/extract_mail", data={"file": (io.BytesIO(data), filename)})
+    assert r.status_code == 413
+    assert "too many attachments: 3 (max 2)" in r.get_json()["error"]
+
+def test_overload_is_429_with_retry_after(client, monkeypatch):
+    admission = excel_api._Admission(1, 0, 0)
+    monkeypatch.setattr(excel_api, "_admission", admission)
+    filename, data = CORPUS["xlsx_skill"]
+    started = admission.acquire("extract")  # 同時実行の枠を埋めておく
+    try:
+        r = client.post("/extract", data={"file": (io.BytesIO(data), filename)})
+    finally:
+        admission.release("extract", started)
+    assert r.status_code == 429
+    assert int(r.headers["Retry-After"]) >= 1
+    assert client.post("/extract", data={"file": (io.BytesIO(data), filename)}).status_code == 200